@@ -108,21 +108,44 @@ def run_sync(func: Callable[..., Any]) -> Callable[..., Coroutine[None, None, An
     return _wrapper
 
 
+def embed_message(kind, ids, model=None):
+    """Compact embed message for many ids, eg `F[1,2,3] txt_embed_ada_2`"""
+    ids = ",".join(str(id) for id in ids)
+    return f"{kind}[{ids}] {model}" if model else f"{kind}[{ids}]"
+
+
+def parse_embed_message(value):
+    """Parse an embed message, either `F12` or `F[1,2,3]`, with an optional model name.
+    Returns the kind (D or F), a list of ids, and the model name or None"""
+    parts = value.split()
+    ids = parts[0][1:]
+    if ids.startswith('['):
+        ids = [int(id) for id in ids.strip('[]').split(',') if id]
+    else:
+        ids = [int(ids)]
+    return parts[0][0], ids, (parts[1] if len(parts) > 1 else None)
+
+
+EMBED_MESSAGE_MAX_IDS = int(config.get("kafka", "embed_message_max_ids", fallback=1000))
+
+
 async def schedule_fragment_embeds(fragment_ids, collections=None, doc_id=None):
     from .kafka import get_channel
+    channel = get_channel("embed")
+    fragment_ids = list(fragment_ids)
     tasks = []
     if doc_id:
-        tasks.append(asyncio.create_task(get_channel("embed").send_soon(key=str(doc_id), value=f"D{doc_id}")))
-    elif collections is None:
-        with Session() as session:
-            r = session.execute(select(Collection).join(DocCollection).filter_by(doc_id=doc_id))
-            collections = [c for (c,) in r]
+        tasks.append(channel.send_soon(key=str(doc_id), value=f"D{doc_id}"))
+        if collections is None:
+            async with Session() as session:
+                r = await session.execute(select(Collection).join(DocCollection).filter_by(doc_id=doc_id))
+                collections = [c for (c,) in r]
 
     extra_models = set(chain(*(c.params.get('embeddings', ()) for c in (collections or ()))))
-    tasks = []
-    for fragment_id in fragment_ids:
-        tasks.append(asyncio.create_task(get_channel("embed").send_soon(key=str(fragment_id), value=f"F{fragment_id}")))
+    for start in range(0, len(fragment_ids), EMBED_MESSAGE_MAX_IDS):
+        ids = fragment_ids[start:start + EMBED_MESSAGE_MAX_IDS]
+        tasks.append(channel.send_soon(key=str(ids[0]), value=embed_message('F', ids)))
         tasks.extend(
-            asyncio.create_task((get_channel("embed").send_soon(key=str(fragment_id), value=f"F{fragment_id} {model}")))
+            channel.send_soon(key=str(ids[0]), value=embed_message('F', ids, model))
             for model in extra_models)
     await asyncio.gather(*tasks)
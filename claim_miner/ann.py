@@ -0,0 +1,237 @@
+"""
+Management of the approximate nearest neighbour (ANN) indexes on the embedding tables.
+Indexes are (re)built with parameters chosen from the table size, search-time recall
+parameters can be set per query, and a benchmark compares ANN results with exact search.
+"""
+# Copyright Society Library and Conversence 2022-2023
+import argparse
+import asyncio
+import logging
+from math import sqrt
+from statistics import mean, quantiles
+from time import perf_counter
+
+import simplejson as json
+from sqlalchemy import text, select
+from sqlalchemy.sql.functions import func
+
+from . import Session, engine, config
+from .models import embed_models, BASE_EMBED_MODEL
+
+logger = logging.getLogger("ann")
+
+ann_method = config.get("ann", "method", fallback="hnsw")
+"""Index method, hnsw (requires pgvector >= 0.5) or ivfflat"""
+default_ef_search = config.getint("ann", "ef_search", fallback=0) or None
+default_probes = config.getint("ann", "probes", fallback=0) or None
+rebuild_growth = config.getfloat("ann", "rebuild_growth", fallback=2.0)
+"""Rebuild an ivfflat index when the table has grown by this factor since the last build"""
+maintenance_work_mem = config.get("ann", "maintenance_work_mem", fallback="1GB")
+PG_EF_SEARCH = 40
+MAX_EF_SEARCH = 1000
+"""pgvector's default and maximum for hnsw.ef_search"""
+ANN_MARGIN = config.getint("search", "ann_margin", fallback=20)
+"""Rows an index scan is sized for beyond those a search needs"""
+EXACT_TIMEOUT = config.getint("search", "exact_timeout", fallback=10000)
+"""Milliseconds an exact search may run"""
+
+
+def index_name(Embedding):
+    return f"{Embedding.__tablename__}_cosidx"
+
+
+def index_params(method, num_rows):
+    "Index parameters appropriate for a table of that size, following pgvector's recommendations"
+    if method == "ivfflat":
+        if num_rows > 1000000:
+            lists = int(sqrt(num_rows))
+        else:
+            lists = max(num_rows // 1000, 10)
+        return dict(lists=lists)
+    elif method == "hnsw":
+        if num_rows > 1000000:
+            return dict(m=24, ef_construction=128)
+        return dict(m=16, ef_construction=64)
+    raise ValueError(f"Unknown index method: {method}")
+
+
+async def get_index_info(conn, name):
+    "Returns the index method and the build information stored in the index comment, if any"
+    r = await conn.execute(text(
+        """SELECT am.amname, obj_description(c.oid, 'pg_class')
+        FROM pg_class c JOIN pg_am am ON am.oid = c.relam
+        WHERE c.relname = :name AND c.relkind = 'i'"""), dict(name=name))
+    r = r.first()
+    if r is None:
+        return None, {}
+    method, comment = r
+    try:
+        info = json.loads(comment) if comment else {}
+    except ValueError:
+        info = {}
+    return method, info
+
+
+def needs_rebuild(current_method, info, method, num_rows):
+    if current_method != method:
+        return True
+    if method == "ivfflat":
+        built_rows = info.get("rows", 0)
+        # ivfflat clusters are computed at build time and degrade as data is added
+        return num_rows >= max(built_rows, 1000) * rebuild_growth
+    return False
+
+
+async def build_index(model=BASE_EMBED_MODEL, method=None, force=False):
+    """Build the ANN index on an embedding table if absent, outdated or of another method.
+    The new index is built concurrently, then swapped with the old one.
+    Returns the build information, or None if nothing was done."""
+    Embedding = embed_models[model]
+    table = Embedding.__tablename__
+    name = index_name(Embedding)
+    method = method or ann_method
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        # Avoid concurrent builds by different processes
+        if not await conn.scalar(text("SELECT pg_try_advisory_lock(hashtext(:name))"), dict(name=name)):
+            logger.info("Index %s is being built by another process", name)
+            return None
+        try:
+            num_rows = await conn.scalar(text(f"SELECT count(*) FROM {table}"))
+            current_method, info = await get_index_info(conn, name)
+            if not (force or needs_rebuild(current_method, info, method, num_rows)):
+                return None
+            params = index_params(method, num_rows)
+            info = dict(method=method, rows=num_rows, params=params)
+            logger.info("Building index %s: %s", name, info)
+            with_clause = ", ".join(f"{k} = {v}" for (k, v) in params.items())
+            await conn.execute(text(f"DROP INDEX IF EXISTS {name}_new"))
+            await conn.execute(text(f"SET maintenance_work_mem = '{maintenance_work_mem}'"))
+            await conn.execute(text(
+                f"CREATE INDEX CONCURRENTLY {name}_new ON {table} "
+                f"USING {method} (embedding vector_cosine_ops) WITH ({with_clause})"))
+            async with engine.begin() as swap_conn:
+                await swap_conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+                await swap_conn.execute(text(f"ALTER INDEX {name}_new RENAME TO {name}"))
+                await swap_conn.execute(text(f"COMMENT ON INDEX {name} IS '{json.dumps(info)}'"))
+            return info
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(hashtext(:name))"), dict(name=name))
+
+
+async def reindex_all(method=None, force=False):
+    results = {}
+    for model in embed_models:
+        results[model] = await build_index(model, method, force)
+    return results
+
+
+async def periodic_reindex(interval, method=None):
+    "Check the indexes every `interval` seconds, and rebuild those that need it"
+    while True:
+        try:
+            await reindex_all(method)
+        except Exception:
+            logger.exception("Reindexing failed")
+        await asyncio.sleep(interval)
+
+
+async def set_search_params(session, ef_search=None, probes=None, min_rows=0, exact=False):
+    """Set the ANN recall parameters for the current transaction.
+    Higher values give better recall at the cost of latency.
+
+    :param min_rows: the number of rows the search needs. A hnsw scan returns at most ``ef_search`` rows,
+        so it is raised to that number, plus a margin, when lower.
+    :param exact: search without the ANN indexes instead, within the ``[search] exact_timeout``
+    """
+    if exact:
+        await session.execute(text("SET LOCAL enable_indexscan = off"))
+        await session.execute(text(f"SET LOCAL statement_timeout = {int(EXACT_TIMEOUT)}"))
+        return
+    ef_search = ef_search or default_ef_search
+    probes = probes or default_probes
+    if min_rows:
+        ef_search = min(max(ef_search or PG_EF_SEARCH, min_rows + ANN_MARGIN), MAX_EF_SEARCH)
+    if ef_search:
+        await session.execute(text(f"SET LOCAL hnsw.ef_search = {int(ef_search)}"))
+    if probes:
+        await session.execute(text(f"SET LOCAL ivfflat.probes = {int(probes)}"))
+
+
+async def benchmark(model=BASE_EMBED_MODEL, num_queries=50, k=10, ef_search_values=(), probes_values=()):
+    """Compare ANN search with exact search on a sample of stored embeddings used as queries.
+    Returns recall at k and latency (in ms) for each setting."""
+    Embedding = embed_models[model]
+    async with Session() as session:
+        r = await session.execute(
+            select(Embedding.embedding).order_by(func.random()).limit(num_queries))
+        queries = [embedding for (embedding,) in r]
+
+    async def run_query(embedding, exact=False, **settings):
+        async with Session() as session:
+            if exact:
+                await session.execute(text("SET LOCAL enable_indexscan = off"))
+            else:
+                await set_search_params(session, **settings)
+            start = perf_counter()
+            r = await session.execute(
+                select(Embedding.doc_id, Embedding.fragment_id
+                ).order_by(Embedding.distance()(embedding)).limit(k))
+            ids = set(r.all())
+            return ids, (perf_counter() - start) * 1000
+
+    exact_results = []
+    exact_times = []
+    for embedding in queries:
+        ids, duration = await run_query(embedding, exact=True)
+        exact_results.append(ids)
+        exact_times.append(duration)
+    settings_list = [dict()]
+    settings_list.extend(dict(ef_search=v) for v in ef_search_values)
+    settings_list.extend(dict(probes=v) for v in probes_values)
+    results = [dict(setting="exact", recall=1.0, **latency_stats(exact_times))]
+    for settings in settings_list:
+        recalls = []
+        times = []
+        for embedding, expected in zip(queries, exact_results):
+            ids, duration = await run_query(embedding, **settings)
+            recalls.append(len(ids & expected) / max(len(expected), 1))
+            times.append(duration)
+        results.append(dict(setting=settings or "default", recall=mean(recalls), **latency_stats(times)))
+    return results
+
+
+def latency_stats(times):
+    if len(times) < 2:
+        return dict(p50=mean(times), p95=mean(times))
+    q = quantiles(times, n=20)
+    return dict(p50=q[9], p95=q[18])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="build the indexes that need it")
+    build_parser.add_argument("--model", choices=list(embed_models.keys()))
+    build_parser.add_argument("--method", choices=["hnsw", "ivfflat"])
+    build_parser.add_argument("--force", action="store_true")
+    build_parser.add_argument("--every", type=int, help="keep running, checking every that many seconds")
+    bench_parser = subparsers.add_parser("benchmark", help="compare recall and latency with exact search")
+    bench_parser.add_argument("--model", choices=list(embed_models.keys()), default=BASE_EMBED_MODEL)
+    bench_parser.add_argument("--queries", type=int, default=50)
+    bench_parser.add_argument("--k", type=int, default=10)
+    bench_parser.add_argument("--ef_search", type=int, nargs="*", default=[])
+    bench_parser.add_argument("--probes", type=int, nargs="*", default=[])
+    args = parser.parse_args()
+    if args.command == "build":
+        if args.every:
+            asyncio.run(periodic_reindex(args.every, args.method))
+        elif args.model:
+            print(asyncio.run(build_index(args.model, args.method, args.force)))
+        else:
+            print(asyncio.run(reindex_all(args.method, args.force)))
+    elif args.command == "benchmark":
+        results = asyncio.run(benchmark(args.model, args.queries, args.k, args.ef_search, args.probes))
+        print(f"{'setting':<24} {'recall':>8} {'p50 ms':>8} {'p95 ms':>8}")
+        for r in results:
+            print(f"{str(r['setting']):<24} {r['recall']:>8.3f} {r['p50']:>8.2f} {r['p95']:>8.2f}")
@@ -11,15 +11,18 @@ from quart_auth import current_user, login_required
 from quart_session import Session
 from quart_jwt_extended import JWTManager
 
-from . import config, production, as_bool
+from . import config, production, as_bool, run_sync
 from .kafka import get_channel, get_producer, stop_producer
+from .lazy import preload, PRELOAD
 
 logger = logging.getLogger("web")
 
 app = Quart("ClaimMiner")
 app.config.from_mapping(config["base"])
 app.config["TEMPLATES_AUTO_RELOAD"] = not production
-app.config["MAX_CONTENT_LENGTH"] = 256 * 1024 * 1024
+# Large JSONL dumps are uploaded as a single request
+app.config["MAX_CONTENT_LENGTH"] = config.getint("base", "max_upload_mb", fallback=256) * 1024 * 1024
+app.config["BODY_TIMEOUT"] = config.getint("base", "upload_timeout", fallback=60)
 app.config["SESSION_TYPE"] = 'memcached'
 app.config["SESSION_KEY_PREFIX"] = 'claimminer_'
 app.config['JWT_SECRET_KEY'] = config.get("base", "secret_key")
@@ -34,6 +37,8 @@ jwt = JWTManager(app)
 @app.before_serving
 async def startup():
     await get_producer()
+    if PRELOAD:
+        await run_sync(preload)(*PRELOAD)
 
 @app.after_serving
 async def shutdown():
@@ -3,6 +3,7 @@ Copyright Society Library and Conversence 2022-2023
 """
 from functools import wraps
 
+from sqlalchemy import true, false, or_
 from sqlalchemy.sql import cast
 from quart import current_app
 from quart.globals import request_ctx
@@ -12,9 +13,10 @@ from quart_auth import (
 
 from . import Session, config, select, production, as_bool
 from .models import (
-    User, permission, Collection, CollectionPermissions, CollectionScope,
-    Document, DocCollection, Fragment, FragmentCollection, permission)
+    User, permission, CollectionPermissions, CollectionScope,
+    Document, DocCollection, Fragment, FragmentCollection)
 from .app import app
+from . import collection_cache
 
 
 class QUser(AuthUser):
@@ -24,17 +26,19 @@ class QUser(AuthUser):
         self._email = None
         self._handle = None
         self._permissions = None
+        self._collection_permissions = {}
 
     async def _resolve(self):
         if not self._resolved:
-            async with Session() as session:
-              r = await session.execute(
-                  select(User).filter_by(id=self.auth_id))
-              (user,) = r.first()
-              self._resolved = True
-              self._email = user.email
-              self._handle = user.handle
-              self._permissions = user.permissions
+            data = collection_cache.users.get(self.auth_id, None)
+            if data is None:
+                async with Session() as session:
+                    r = await session.execute(
+                        select(User.email, User.handle, User.permissions).filter_by(id=self.auth_id))
+                    data = tuple(r.one())
+                collection_cache.users.set(self.auth_id, data)
+            self._resolved = True
+            (self._email, self._handle, self._permissions) = data
 
     @property
     async def email(self):
@@ -55,6 +59,27 @@ class QUser(AuthUser):
         permissions = await self.permissions or []
         return perm in permissions or "admin" in permissions
 
+    async def collection_permissions(self, collection):
+        """The id of a collection (given by name or instance; None if unknown) and the user's permissions in it.
+        Memoized for the lifetime of the user object, i.e. the request."""
+        name = collection if isinstance(collection, str) else collection.name
+        if name not in self._collection_permissions:
+            try:
+                coll, permissions = await collection_cache.load_collection(name, self.auth_id)
+                self._collection_permissions[name] = (coll.id, permissions or [])
+            except ValueError:
+                self._collection_permissions[name] = (None, [])
+        return self._collection_permissions[name]
+
+    async def can_in(self, perm: permission, collection=None):
+        "Whether the user has a permission globally, or in the collection"
+        if await self.can(perm):
+            return True
+        if not collection:
+            return False
+        _, permissions = await self.collection_permissions(collection)
+        return perm in permissions or "admin" in permissions
+
 
 def requires_permission(perm: permission):
     def requires_permission_decorator(func):
@@ -73,29 +98,21 @@ def requires_permission(perm: permission):
     return requires_permission_decorator
 
 
+async def check_collection_permission(perm: permission, collection):
+    "Raise Unauthorized unless the current user has the permission, globally or in the collection"
+    if not await current_user.is_authenticated:
+        raise Unauthorized()
+    if not await current_user.can_in(perm, collection):
+        raise Unauthorized()
+
+
 def requires_collection_permission(perm: permission):
     def requires_permission_decorator(func):
         "A decorator to restrict route access to users with a given permission"
 
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            if not await current_user.is_authenticated:
-                raise Unauthorized()
-            elif not await current_user.can(perm):
-                collection = kwargs.get("collection", None)
-                if not collection:
-                    raise Unauthorized()
-                async with Session() as session:
-                    collection_name = collection if isinstance(collection, str) else collection.name
-                    q = select(CollectionPermissions.permissions
-                        ).join(Collection
-                        ).filter(
-                            CollectionPermissions.user_id==current_user.auth_id,
-                            Collection.name == collection_name)
-                    r = await session.execute(q)
-                    r = r.first()
-                    if r is None or perm not in r[0]:
-                        raise Unauthorized()
+            await check_collection_permission(perm, kwargs.get("collection", None))
             return await current_app.ensure_async(func)(*args, **kwargs)
 
         return wrapper
@@ -108,153 +125,90 @@ def may_require_collection_permission(perm: permission):
 
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            if not await current_user.is_authenticated:
-                raise Unauthorized()
-            elif not await current_user.can(perm):
-                collection = kwargs.get("collection", None)
-                if not collection:
-                    raise Unauthorized()
-                async with Session() as session:
-                    collection_name = collection if isinstance(collection, str) else collection.name
-                    q = select(CollectionPermissions.permissions
-                        ).join(Collection
-                        ).filter(
-                            CollectionPermissions.user_id==current_user.auth_id,
-                            Collection.name == collection_name)
-                    r = await session.execute(q)
-                    r = r.first()
-                    if r is None or perm not in r[0]:
-                        raise Unauthorized()
+            await check_collection_permission(perm, kwargs.get("collection", None))
             return await current_app.ensure_async(func)(*args, **kwargs)
 
         return wrapper
     return requires_permission_decorator
 
 
-async def doc_collection_constraints(query, collection=None, perm='access', include_in_collection=True, include_outside_collection=None):
+async def access_condition(link_item, item_id, collection=None, perm='access', include_in_collection=True, include_outside_collection=None):
+    """A boolean SQL expression: whether the current user has a permission on the documents or fragments of a query.
+    It uses correlated subqueries rather than joins, so it can be used as a filter or a column of any query on those items
+    without duplicating rows. The user's permissions are evaluated once per request.
+
+    :param link_item: the item column of the association table with collections, e.g. ``DocCollection.doc_id``
+    :param item_id: the item id column in the query, e.g. ``Document.id``
+    :param collection: restrict to items in that collection (and outside any collection, if include_outside_collection)
+    """
     if collection:
         include_in_collection = True
-        collection_name = collection if isinstance(collection, str) else collection.name
     if include_outside_collection is None:
         include_outside_collection = not collection
     assert include_in_collection or include_outside_collection
-    if not collection:
-        if await current_user.can(perm):
-            return query
-        if include_in_collection:
-            if include_outside_collection:
-                return query.outerjoin(DocCollection, Document.id==DocCollection.doc_id
-                    ).outerjoin(CollectionPermissions, (CollectionPermissions.collection_id==DocCollection.collection_id)
-                        & (CollectionPermissions.user_id==current_user.auth_id)
-                    ).filter((DocCollection.collection_id == None
-                        ) | ((CollectionPermissions.permissions != None)
-                            & CollectionPermissions.permissions.any(cast(perm, permission))))
-            else:
-                return query.join(DocCollection, Document.id==DocCollection.doc_id
-                    ).join(CollectionPermissions, (CollectionPermissions.collection_id==DocCollection.collection_id)
-                        & (CollectionPermissions.user_id==current_user.auth_id)
-                    ).filter((CollectionPermissions.permissions != None)
-                            & CollectionPermissions.permissions.any(cast(perm, permission)))
+    link = link_item.class_
+    outside = ~select(link.collection_id).filter(link_item == item_id).exists()
+    if collection:
+        collection_id, _ = await current_user.collection_permissions(collection)
+        if collection_id is None or not await current_user.can_in(perm, collection):
+            inside = false()
         else:
-            return query.outerjoin(DocCollection, Document.id==DocCollection.doc_id
-                ).filter(DocCollection.collection_id == None)
+            inside = select(link.collection_id).filter(link_item == item_id, link.collection_id == collection_id).exists()
+    elif await current_user.can(perm):
+        return true()
+    elif include_in_collection:
+        permitted = select(CollectionPermissions.collection_id).filter(
+            CollectionPermissions.user_id == current_user.auth_id,
+            CollectionPermissions.permissions.any(cast(perm, permission)))
+        inside = select(link.collection_id).filter(link_item == item_id, link.collection_id.in_(permitted)).exists()
     else:
-        # todo: no access needed for main connection.
-        generic_permissions = await current_user.can(perm)
-        coll_perm_cond = ((CollectionPermissions.permissions != None)
-            & CollectionPermissions.permissions.any(cast(perm, permission)))
-        if include_outside_collection:
-            query = query.outerjoin(DocCollection, Document.id==DocCollection.doc_id
-                ).outerjoin(Collection, Collection.id==DocCollection.collection_id
-                ).filter((Collection.name == collection_name) | (Collection.name == None))
-            if not generic_permissions:
-                query = query.outerjoin(CollectionPermissions, (CollectionPermissions.collection_id==DocCollection.collection_id)
-                    & (CollectionPermissions.user_id==current_user.auth_id)
-                ).filter((Collection.name == None) | coll_perm_cond)
-        else:
-            query = query.join(DocCollection, Document.id==DocCollection.doc_id
-                ).join(Collection, Collection.id==DocCollection.collection_id
-                ).filter(Collection.name == collection_name)
-            if not generic_permissions:
-                query = query.join(CollectionPermissions, (CollectionPermissions.collection_id==DocCollection.collection_id)
-                    & (CollectionPermissions.user_id==current_user.auth_id)
-                ).filter(coll_perm_cond)
-    return query
+        return outside
+    if include_outside_collection:
+        return or_(outside, inside)
+    return inside
 
 
-async def check_doc_access(doc_id, collection=None, perm='access'):
-    if await current_user.can(perm):
-        return True
-    q = await doc_collection_constraints(select(Document).filter(Document.id == doc_id), collection, perm)
-    async with Session() as session:
-        r = await session.execute(q)
-        r = r.first()
-    if r is None:
+async def doc_access_condition(collection=None, perm='access', include_in_collection=True, include_outside_collection=None):
+    return await access_condition(DocCollection.doc_id, Document.id, collection, perm, include_in_collection, include_outside_collection)
+
+
+async def fragment_access_condition(collection=None, perm='access', include_in_collection=True, include_outside_collection=None):
+    return await access_condition(FragmentCollection.fragment_id, Fragment.id, collection, perm, include_in_collection, include_outside_collection)
+
+
+async def doc_collection_constraints(query, collection=None, perm='access', include_in_collection=True, include_outside_collection=None):
+    return query.filter(await doc_access_condition(collection, perm, include_in_collection, include_outside_collection))
+
+
+async def fragment_collection_constraints(query, collection=None, perm='access', include_in_collection=True, include_outside_collection=None):
+    return query.filter(await fragment_access_condition(collection, perm, include_in_collection, include_outside_collection))
+
+
+async def check_access(condition, item_filter, session=None):
+    if session is None:
+        async with Session() as session:
+            return await check_access(condition, item_filter, session)
+    r = await session.execute(select(condition).filter(item_filter))
+    r = r.first()
+    if r is None or not r[0]:
         raise Unauthorized()
     return True
 
 
-async def fragment_collection_constraints(query, collection=None, perm='access', include_in_collection=True, include_outside_collection=None):
-    if collection:
-        include_in_collection = True
-        collection_name = collection if isinstance(collection, str) else collection.name
-    if include_outside_collection is None:
-        include_outside_collection = not collection
-    assert include_in_collection or include_outside_collection
-    if not collection:
-        if await current_user.can(perm):
-            return query
-        if include_in_collection:
-            if include_outside_collection:
-                return query.outerjoin(FragmentCollection, Fragment.id==FragmentCollection.fragment_id
-                    ).outerjoin(CollectionPermissions, (CollectionPermissions.collection_id==FragmentCollection.collection_id)
-                        & (CollectionPermissions.user_id==current_user.auth_id)
-                    ).filter((FragmentCollection.collection_id == None
-                        ) | ((CollectionPermissions.permissions != None)
-                            & CollectionPermissions.permissions.any(cast(perm, permission))))
-            else:
-                return query.join(FragmentCollection, Fragment.id==FragmentCollection.fragment_id
-                    ).join(CollectionPermissions, (CollectionPermissions.collection_id==FragmentCollection.collection_id)
-                        & (CollectionPermissions.user_id==current_user.auth_id)
-                    ).filter((CollectionPermissions.permissions != None)
-                            & CollectionPermissions.permissions.any(cast(perm, permission)))
-        else:
-            return query.outerjoin(FragmentCollection, Fragment.id==FragmentCollection.fragment_id
-                ).filter(FragmentCollection.collection_id == None)
-    else:
-        # todo: no access needed for main connection.
-        generic_permissions = await current_user.can(perm)
-        coll_perm_cond = ((CollectionPermissions.permissions != None)
-            & CollectionPermissions.permissions.any(cast(perm, permission)))
-        if include_outside_collection:
-            query = query.outerjoin(FragmentCollection, Fragment.id==FragmentCollection.fragment_id
-                ).outerjoin(Collection, Collection.id==FragmentCollection.collection_id
-                ).filter((Collection.name == collection_name) | (Collection.name == None))
-            if not generic_permissions:
-                query = query.outerjoin(CollectionPermissions, (CollectionPermissions.collection_id==FragmentCollection.collection_id)
-                    & (CollectionPermissions.user_id==current_user.auth_id)
-                ).filter((Collection.name == None) | coll_perm_cond)
-        else:
-            query = query.join(FragmentCollection, Fragment.id==FragmentCollection.fragment_id
-                ).join(Collection, Collection.id==FragmentCollection.collection_id
-                ).filter(Collection.name == collection_name)
-            if not generic_permissions:
-                query = query.join(CollectionPermissions, (CollectionPermissions.collection_id==FragmentCollection.collection_id)
-                    & (CollectionPermissions.user_id==current_user.auth_id)
-                ).filter(coll_perm_cond)
-    return query
+async def check_doc_access(doc_id, collection=None, perm='access', session=None):
+    """Raise Unauthorized unless the current user has a permission on the document.
+    Views that query the document anyway should rather add :py:func:`doc_access_condition` to their query."""
+    if await current_user.can(perm):
+        return True
+    return await check_access(await doc_access_condition(collection, perm), Document.id == doc_id, session)
 
 
-async def check_fragment_access(fragment_id, collection=None, perm='access'):
+async def check_fragment_access(fragment_id, collection=None, perm='access', session=None):
+    "Raise Unauthorized unless the current user has a permission on the fragment."
     if await current_user.can(perm):
         return True
-    q = fragment_collection_constraints(select(Document), collection, perm).filter(Document.id == fragment_id)
-    async with Session() as session:
-        r = await session.execute(q)
-        r = r.first()
-    if r is None:
-        raise Unauthorized()
-    return True
+    return await check_access(await fragment_access_condition(collection, perm), Fragment.id == fragment_id, session)
+
 
 async def set_user(user_id):
     user = QUser(user_id)
@@ -0,0 +1,140 @@
+"""
+Short-lived, in-process caches of collections, collection names, and user permissions,
+which nearly every request needs before doing any work.
+Entries expire after ``[cache] collections_ttl`` seconds, so changes made by other processes show up quickly;
+commits that change collections, users or permissions in this process clear the caches at once.
+"""
+# Copyright Society Library and Conversence 2022-2023
+from copy import deepcopy
+from itertools import chain
+from time import monotonic
+
+from sqlalchemy import event, select, inspect
+from sqlalchemy.orm import Session as SyncSession, make_transient_to_detached
+
+from . import config
+from .models import Collection, CollectionPermissions, User
+
+CACHE_TTL = config.getint("cache", "collections_ttl", fallback=30)
+CACHE_MAX_SIZE = config.getint("cache", "max_users", fallback=10000)
+WATCHED_CLASSES = (Collection, CollectionPermissions, User)
+"""Changes to instances of these classes invalidate the caches"""
+
+MISSING = object()
+
+
+class TTLCache():
+    "A dictionary whose entries expire"
+
+    def __init__(self, ttl=CACHE_TTL, max_size=CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.data = {}
+
+    def get(self, key, default=MISSING):
+        entry = self.data.get(key)
+        if entry is None:
+            return default
+        if entry[0] < monotonic():
+            del self.data[key]
+            return default
+        return entry[1]
+
+    def set(self, key, value):
+        if len(self.data) >= self.max_size:
+            now = monotonic()
+            self.data = {k: v for (k, v) in self.data.items() if v[0] >= now}
+            if len(self.data) >= self.max_size:
+                del self.data[next(iter(self.data))]
+        self.data[key] = (monotonic() + self.ttl, value)
+
+    def clear(self):
+        self.data.clear()
+
+
+collections = TTLCache()
+"""Detached copies of the collections, by name"""
+collection_permissions = TTLCache()
+"""The permissions of a user in a collection, by (user_id, collection_id)"""
+collection_names = TTLCache()
+users = TTLCache()
+"""The email, handle and global permissions of users, by id"""
+
+
+def invalidate():
+    for cache in (collections, collection_permissions, collection_names, users):
+        cache.clear()
+
+
+def detached_copy(collection):
+    "A copy of the collection that is not bound to a session, and can be merged into any session without a query"
+    copy = Collection(id=collection.id, name=collection.name, params=deepcopy(collection.params))
+    make_transient_to_detached(copy)
+    return copy
+
+
+async def attach(session, cached):
+    "The session's instance of a cached collection, without querying the database"
+    existing = session.identity_map.get(inspect(cached).key)
+    if existing is not None:
+        return existing
+    return await session.merge(detached_copy(cached), load=False)
+
+
+async def load_collection(name, user_id=None, session=None):
+    """The collection of that name, and the user's permissions in it (or None), from the cache if possible.
+    The collection is a detached copy: merge it into a session to use it there.
+
+    :raises ValueError: if the collection does not exist
+    """
+    collection = collections.get(name)
+    permissions = collection_permissions.get((user_id, collection.id)) if (user_id and collection is not MISSING) else None
+    if collection is not MISSING and permissions is not MISSING:
+        return collection, permissions
+    if session is None:
+        from . import Session
+        async with Session() as session:
+            return await load_collection(name, user_id, session)
+    q = select(Collection).filter_by(name=name).limit(1)
+    if user_id:
+        q = q.outerjoin(
+            CollectionPermissions,
+            (CollectionPermissions.collection_id == Collection.id) &
+            (CollectionPermissions.user_id == user_id)
+            ).add_columns(CollectionPermissions.permissions)
+    r = await session.execute(q)
+    r = r.first()
+    if not r:
+        raise ValueError("Unknown collection: ", name)
+    collection = detached_copy(r[0])
+    collections.set(name, collection)
+    if user_id:
+        permissions = r[1]
+        collection_permissions.set((user_id, collection.id), permissions)
+    return collection, permissions
+
+
+async def get_collection_names(session):
+    names = collection_names.get(None)
+    if names is MISSING:
+        r = await session.execute(select(Collection.name))
+        names = [n for (n,) in r]
+        collection_names.set(None, names)
+    return names
+
+
+@event.listens_for(SyncSession, "after_flush")
+def _note_changes(session, flush_context):
+    if any(isinstance(obj, WATCHED_CLASSES) for obj in chain(session.new, session.dirty, session.deleted)):
+        session.info['invalidate_collection_cache'] = True
+
+
+@event.listens_for(SyncSession, "after_commit")
+def _invalidate_after_commit(session):
+    if session.info.pop('invalidate_collection_cache', False):
+        invalidate()
+
+
+@event.listens_for(SyncSession, "after_rollback")
+def _forget_changes(session):
+    session.info.pop('invalidate_collection_cache', None)
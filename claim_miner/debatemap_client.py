@@ -10,6 +10,7 @@ from gql.transport.websockets import WebsocketsTransport
 from gql.transport.exceptions import TransportAlreadyConnected
 
 from . import config
+from .lazy import lazy_resource
 
 
 timeout = int(config.get('debatemap', 'timeout', fallback=300))
@@ -34,7 +35,7 @@ def getClient():
     return Client(
         transport=transport, fetch_schema_from_transport=True, execute_timeout=timeout)
 
-client = getClient()
+client = lazy_resource("debatemap_client")(getClient)
 
 
 def getWsTransport():
@@ -44,7 +45,7 @@ def getWsTransport():
 
 @backoff.on_exception(backoff.expo, TransportAlreadyConnected, max_time=timeout)
 async def debatemap_query(query, **kwargs):
-    async with client as session:
+    async with client.get() as session:
         return await session.execute(query, variable_values=kwargs)
 
 
@@ -0,0 +1,141 @@
+"""
+A shared HTTP downloader, with a long-lived pooled client, per-host politeness limits,
+retries with backoff, and conditional requests.
+"""
+# Copyright Society Library and Conversence 2022-2023
+import asyncio
+import logging
+import random
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from email.utils import format_datetime
+from time import monotonic
+from urllib.parse import urlsplit
+
+import httpx
+from pytz import utc
+
+from . import config
+
+logger = logging.getLogger("download")
+
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class HostLimiter():
+    """Limits the number of concurrent requests to a host, and the interval between their starts."""
+
+    def __init__(self, concurrency, min_interval):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.min_interval = min_interval
+        self.next_start = 0
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        if self.min_interval:
+            async with self.lock:
+                delay = self.next_start - monotonic()
+                self.next_start = max(self.next_start, monotonic()) + self.min_interval
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def __aexit__(self, *args):
+        self.semaphore.release()
+
+
+class Downloader():
+    """Downloads documents with a shared connection pool.
+
+    :param per_host: maximum concurrent requests to one host
+    :param host_rate: maximum requests per second to one host (0 for no limit)
+    :param retries: how many times to retry after a transport error or a transient status
+    :param backoff: initial delay before retrying, in seconds, doubled each time
+    """
+
+    def __init__(self, per_host=4, host_rate=0, timeout=30, retries=3, backoff=1.0, max_connections=100, user_agent=None):
+        self.per_host = per_host
+        self.min_interval = 1.0 / host_rate if host_rate else 0
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_connections = max_connections
+        self.user_agent = user_agent
+        self.hosts = defaultdict(lambda: HostLimiter(self.per_host, self.min_interval))
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            headers = {"User-Agent": self.user_agent} if self.user_agent else None
+            self._client = httpx.AsyncClient(
+                http2=HTTP2, follow_redirects=True, headers=headers,
+                timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 10)),
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections // 2))
+        return self._client
+
+    def retry_delay(self, attempt, response=None):
+        if response is not None and (retry_after := response.headers.get("Retry-After", "")).isdigit():
+            return min(int(retry_after), 300)
+        return self.backoff * (2 ** attempt) * (0.5 + random.random())
+
+    @asynccontextmanager
+    async def stream(self, url, etag=None, modified=None):
+        """GET a URL, yielding the response before its body is read.
+        If the etag or modification date of a previous download are given,
+        the request is conditional, and the response may be a 304 Not Modified.
+        The host's concurrency slot is held until the body is read."""
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if modified:
+            headers["If-Modified-Since"] = format_datetime(utc.localize(modified) if modified.tzinfo is None else modified, usegmt=True)
+        host = urlsplit(url).hostname
+        attempt = 0
+        while True:
+            response = None
+            async with self.hosts[host]:
+                try:
+                    response = await self.client.send(self.client.build_request("GET", url, headers=headers), stream=True)
+                except httpx.TransportError as e:
+                    if attempt >= self.retries:
+                        raise
+                    logger.info("Error downloading %s: %s", url, e)
+                else:
+                    if response.status_code not in RETRY_STATUS or attempt >= self.retries:
+                        try:
+                            yield response
+                        finally:
+                            await response.aclose()
+                        return
+                    await response.aclose()
+            await asyncio.sleep(self.retry_delay(attempt, response))
+            attempt += 1
+
+    async def get(self, url, etag=None, modified=None):
+        "GET a URL and read the response body. See :py:meth:`stream`"
+        async with self.stream(url, etag, modified) as response:
+            await response.aread()
+            return response
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+downloader = Downloader(
+    per_host=config.getint("download", "per_host", fallback=4),
+    host_rate=config.getfloat("download", "host_rate", fallback=0),
+    timeout=config.getfloat("download", "timeout", fallback=30),
+    retries=config.getint("download", "retries", fallback=3),
+    backoff=config.getfloat("download", "backoff", fallback=1.0),
+    max_connections=config.getint("download", "max_connections", fallback=100),
+    user_agent=config.get("download", "user_agent", fallback=None))
+"""The shared downloader"""
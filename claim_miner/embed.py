@@ -1,32 +1,56 @@
 """
 Copyright Society Library and Conversence 2022-2023
 """
+import logging
+
 import numpy as np
 from asyncio import sleep
 from . import config, run_sync
-from .models import BASE_EMBED_MODEL
+from .embed_cache import embed_cache
+from .embed_server import EMBED_SERVER, embed_remote
+from .lazy import lazy_resource
+from .models import BASE_EMBED_MODEL, OPENAI_EMBED_MODEL
+
+logger = logging.getLogger("embed")
+
+# Limits on each embedding call: number of texts, total characters, and characters per text.
+# Characters are used as a cheap proxy for tokens (about 4 characters per token in English.)
+batch_limits = {
+    BASE_EMBED_MODEL: dict(
+        max_items=config.getint("embed", "use4_batch_items", fallback=128),
+        max_chars=config.getint("embed", "use4_batch_chars", fallback=200000),
+        max_text_chars=None,
+    ),
+    OPENAI_EMBED_MODEL: dict(
+        max_items=config.getint("embed", "ada2_batch_items", fallback=1000),
+        max_chars=config.getint("embed", "ada2_batch_chars", fallback=400000),
+        max_text_chars=config.getint("embed", "ada2_text_chars", fallback=24000),  # 8191 tokens
+    ),
+}
+
+
+@lazy_resource("use4")
+def use4():
+    import tensorflow_hub as hub
+    import tensorflow as tf
+    model = hub.load("https://tfhub.dev/google/universal-sentence-encoder/4")
+    return lambda texts: list(normalization(model(tf.constant(texts)).numpy()).astype(float))
+
+
+@lazy_resource("openai")
+def openai_embedding():
+    import openai
+    openai.organization = config.get("openai", "organization")
+    openai.api_key =  config.get("openai", "api_key")
+    return openai.Embedding
 
-USE4 = None
-ADA2 = None
 
 def get_use4():
-    global USE4
-    if USE4 is None:
-        import tensorflow_hub as hub
-        import tensorflow as tf
-        model = hub.load("https://tfhub.dev/google/universal-sentence-encoder/4")
-        USE4 = lambda text: normalization(model(tf.constant([text])))[0].numpy().astype(float)
-    return USE4
+    return use4.get()
 
 
 def get_openai():
-    global ADA2
-    if ADA2 is None:
-        import openai
-        openai.organization = config.get("openai", "organization")
-        openai.api_key =  config.get("openai", "api_key")
-        ADA2 = openai.Embedding
-    return ADA2
+    return openai_embedding.get()
 
 
 def normalization(embeds):
@@ -34,28 +58,74 @@ def normalization(embeds):
     return embeds/norms
 
 
+def make_batches(texts, max_items, max_chars):
+    """Pack texts into batches bounded by number of texts and total size.
+    Texts are sorted by length first, so each batch holds texts of similar size (less padding).
+    Yields lists of indices into the original list."""
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    batch = []
+    size = 0
+    for i in order:
+        l = len(texts[i])
+        if batch and (len(batch) >= max_items or size + l > max_chars):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(i)
+        size += l
+    if batch:
+        yield batch
+
+
+async def embed_use4(texts):
+    if EMBED_SERVER:
+        try:
+            return await embed_remote(texts, BASE_EMBED_MODEL)
+        except OSError as e:
+            logger.warning("Embedding server unavailable, embedding in-process: %s", e)
+    return await run_sync(get_use4())(texts)
+
+
+async def embed_ada2(texts):
+    from openai.error import RateLimitError
+    max_text_chars = batch_limits[OPENAI_EMBED_MODEL]['max_text_chars']
+    if any(len(t) > max_text_chars for t in texts):
+        logger.warning("Truncating texts longer than %d characters", max_text_chars)
+        texts = [t[:max_text_chars] for t in texts]
+    while True:
+        try:
+            results = await get_openai().acreate(model="text-embedding-ada-002", input=texts)
+            break
+        except RateLimitError:
+            await sleep(20)
+    return [r['embedding'] for r in sorted(results['data'], key=lambda r: r['index'])]
+
+
+embedders = {
+    BASE_EMBED_MODEL: embed_use4,
+    OPENAI_EMBED_MODEL: embed_ada2,
+}
+
+
 async def tf_embed(text, model=BASE_EMBED_MODEL):
-    if model == BASE_EMBED_MODEL:
-        if isinstance(text, list):
-            result = []
-            for t in text:
-                result.append(await tf_embed(t, model))
-            return result
-        return await run_sync(get_use4())(text)
-    elif model == 'txt_embed_ada_2':
-        from openai.error import RateLimitError
-        if is_single := not isinstance(text, list):
-            text = [text]
-        # TODO: Batch by size, handle oversize...
-        while True:
-            try:
-                results = await get_openai().acreate(model="text-embedding-ada-002", input=text)
-                break
-            except RateLimitError:
-                await sleep(20)
-        results = [r['embedding'] for r in results['data']]
-        if is_single:
-            results = results[0]
-        return results
-    else:
+    """Embed a text or a list of texts with the given model.
+    Cached embeddings are reused; other texts are sent in size-bounded batches.
+    Results are returned in input order."""
+    if model not in embedders:
         raise RuntimeError(f"Unknown model: {model}")
+    if is_single := not isinstance(text, list):
+        text = [text]
+    embedder = embedders[model]
+    limits = batch_limits[model]
+    cached = await embed_cache.get_many(model, text) if embed_cache else {}
+    to_embed = [t for t in dict.fromkeys(text) if t not in cached]
+    computed = {}
+    for batch in make_batches(to_embed, limits['max_items'], limits['max_chars']):
+        batch_texts = [to_embed[i] for i in batch]
+        computed.update(zip(batch_texts, await embedder(batch_texts)))
+    if embed_cache:
+        await embed_cache.put_many(model, computed)
+    results = [cached[t] if t in cached else computed[t] for t in text]
+    if is_single:
+        return results[0]
+    return results
@@ -0,0 +1,151 @@
+"""
+A content-addressed cache of embeddings, keyed by model name and a hash of the normalized text.
+It has an in-memory LRU tier and an optional sqlite disk tier, both bounded in size.
+Both tiers hold float64 vectors, so an embedding is the same whichever tier returns it.
+"""
+# Copyright Society Library and Conversence 2022-2023
+from collections import OrderedDict
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock
+import logging
+import sqlite3
+import unicodedata
+
+import numpy as np
+
+from . import config, run_sync
+
+logger = logging.getLogger("embed")
+
+CONFIG_DIR = Path(__file__).parent.parent
+CACHE_FILE = config.get("embed", "cache_file", fallback="embed_cache.sqlite")
+"""The sqlite file of the disk tier, relative to the directory of config.ini; empty to disable the disk tier"""
+STATS_INTERVAL = config.getint("embed", "cache_stats_interval", fallback=10000)
+"""The hit and miss counts are logged every that many lookups; 0 to never log them"""
+
+
+def normalize_text(text):
+    return unicodedata.normalize("NFC", text).strip()
+
+
+def text_key(model, text):
+    return f"{model}:{sha256(normalize_text(text).encode('utf-8')).hexdigest()}"
+
+
+class EmbeddingCache():
+    def __init__(self, memory_items=10000, disk_file=None, disk_items=1000000, stats_interval=STATS_INTERVAL):
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self.memory = OrderedDict()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.stats_interval = stats_interval
+        self._lookups_since_log = 0
+        self._lock = Lock()
+        self._writes_since_trim = 0
+        self.disk_file = disk_file
+        self._db = None
+
+    @property
+    def db(self):
+        "The connection to the disk tier, opened on first use; None without a disk tier"
+        if self._db is None and self.disk_file:
+            with self._lock:
+                if self._db is None:
+                    db = sqlite3.connect(self.disk_file, check_same_thread=False, isolation_level=None)
+                    db.execute("PRAGMA journal_mode=WAL")
+                    # Vectors are float64; the table of earlier versions held float32 vectors.
+                    # Dropping it frees its pages for the new table.
+                    db.execute("DROP TABLE IF EXISTS embedding")
+                    db.execute("""CREATE TABLE IF NOT EXISTS embedding64 (
+                        key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used INTEGER NOT NULL)""")
+                    db.execute("CREATE INDEX IF NOT EXISTS embedding64_last_used ON embedding64 (last_used)")
+                    self._clock = db.execute("SELECT coalesce(max(last_used), 0) FROM embedding64").fetchone()[0]
+                    self._db = db
+        return self._db
+
+    def stats(self):
+        return dict(
+            hits_memory=self.hits_memory, hits_disk=self.hits_disk, misses=self.misses,
+            memory_items=len(self.memory))
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def _get_disk(self, keys):
+        rows = []
+        db = self.db
+        with self._lock:
+            self._clock += 1
+            # Stay below sqlite's limit on the number of parameters
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start+500]
+                placeholders = ",".join("?" * len(chunk))
+                chunk_rows = db.execute(
+                    f"SELECT key, vector FROM embedding64 WHERE key IN ({placeholders})", chunk).fetchall()
+                if chunk_rows:
+                    db.executemany(
+                        "UPDATE embedding64 SET last_used = ? WHERE key = ?",
+                        [(self._clock, k) for (k, _) in chunk_rows])
+                rows.extend(chunk_rows)
+        return {k: np.frombuffer(v, dtype=np.float64) for (k, v) in rows}
+
+    def _put_disk(self, items):
+        db = self.db
+        with self._lock:
+            self._clock += 1
+            db.executemany(
+                "INSERT OR REPLACE INTO embedding64 (key, vector, last_used) VALUES (?, ?, ?)",
+                [(k, v.tobytes(), self._clock) for (k, v) in items.items()])
+            self._writes_since_trim += len(items)
+            if self._writes_since_trim > self.disk_items // 100:
+                self._writes_since_trim = 0
+                db.execute(
+                    "DELETE FROM embedding64 WHERE key IN (SELECT key FROM embedding64 ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.disk_items,))
+
+    async def get_many(self, model, texts):
+        "Returns a dictionary of cached embeddings, by text"
+        keys = {text: text_key(model, text) for text in texts}
+        found = {}
+        missing = {}
+        for text, key in keys.items():
+            if (vector := self.memory.get(key)) is not None:
+                self.memory.move_to_end(key)
+                found[text] = vector
+            else:
+                missing[key] = text
+        self.hits_memory += len(found)
+        if missing and self.disk_file:
+            from_disk = await run_sync(self._get_disk)(list(missing))
+            for key, vector in from_disk.items():
+                self._remember(key, vector)
+                found[missing.pop(key)] = vector
+            self.hits_disk += len(from_disk)
+        self.misses += len(missing)
+        self._lookups_since_log += len(keys)
+        if self.stats_interval and self._lookups_since_log >= self.stats_interval:
+            self._lookups_since_log = 0
+            logger.info("Embedding cache: %s", self.stats())
+        return found
+
+    async def put_many(self, model, embeddings):
+        "Store a dictionary of embeddings, by text"
+        items = {text_key(model, text): np.asarray(vector, dtype=np.float64) for text, vector in embeddings.items()}
+        for key, vector in items.items():
+            self._remember(key, vector)
+        if items and self.disk_file:
+            await run_sync(self._put_disk)(items)
+
+
+embed_cache = None
+if config.getboolean("embed", "cache", fallback=True):
+    embed_cache = EmbeddingCache(
+        memory_items=config.getint("embed", "cache_memory_items", fallback=10000),
+        disk_file=CACHE_FILE and Path(CONFIG_DIR, CACHE_FILE),
+        disk_items=config.getint("embed", "cache_disk_items", fallback=1000000))
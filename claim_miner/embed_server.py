@@ -0,0 +1,183 @@
+"""
+A local embedding server, which keeps the local embedding models loaded in one process per host.
+Requests from all the web and worker processes are batched together dynamically:
+a batch is sent to the model when it is full, or when the first request in it has waited long enough.
+
+The protocol is one line of JSON per request and per response, over a Unix socket (or TCP, as `host:port`).
+:py:func:`claim_miner.embed.tf_embed` uses the server when ``[embed] server`` is set,
+and embeds in-process if it cannot be reached.
+
+Run with ``python -m claim_miner.embed_server``.
+"""
+# Copyright Society Library and Conversence 2022-2023
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import simplejson as json
+
+from . import config
+from .models import BASE_EMBED_MODEL
+
+logger = logging.getLogger("embed_server")
+
+EMBED_SERVER = config.get("embed", "server", fallback=None)
+"""The server address: a Unix socket path, or host:port. Empty to embed in-process."""
+SERVER_WAIT_MS = config.getint("embed", "server_wait_ms", fallback=10)
+"""How long a request can wait for others to fill its batch"""
+SERVER_BATCH_ITEMS = config.getint("embed", "server_batch_items", fallback=256)
+SERVER_BATCH_CHARS = config.getint("embed", "server_batch_chars", fallback=400000)
+LINE_LIMIT = 256 * 1024 * 1024
+
+
+class EmbedServerError(RuntimeError):
+    pass
+
+
+def parse_address(address):
+    "A (host, port) pair for TCP addresses, or None for a Unix socket path"
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit() and '/' not in address:
+        return host, int(port)
+    return None
+
+
+class Batcher():
+    """Collects the texts of concurrent requests for a model into batches.
+
+    :param embed: a blocking function embedding a list of texts
+    """
+
+    def __init__(self, embed, max_items=SERVER_BATCH_ITEMS, max_chars=SERVER_BATCH_CHARS, max_wait=SERVER_WAIT_MS / 1000):
+        self.embed_fn = embed
+        self.max_items = max_items
+        self.max_chars = max_chars
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.carry = None
+        self.task = None
+        # The model is not run concurrently with itself
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="embed")
+
+    async def embed(self, texts):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((texts, future))
+        return await future
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        if self.carry:
+            first, self.carry = self.carry, None
+        else:
+            first = await self.queue.get()
+        batch = [first]
+        num_items = len(first[0])
+        num_chars = sum(len(t) for t in first[0])
+        deadline = loop.time() + self.max_wait
+        while num_items < self.max_items and num_chars < self.max_chars:
+            try:
+                item = await asyncio.wait_for(self.queue.get(), max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                break
+            item_chars = sum(len(t) for t in item[0])
+            if num_items + len(item[0]) > self.max_items or num_chars + item_chars > self.max_chars:
+                self.carry = item
+                break
+            batch.append(item)
+            num_items += len(item[0])
+            num_chars += item_chars
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            texts = [text for (texts, _) in batch for text in texts]
+            try:
+                embeddings = await loop.run_in_executor(self.executor, self.embed_fn, texts)
+            except Exception as e:
+                logger.exception("Embedding failed")
+                for (_, future) in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            logger.debug("Embedded %d texts from %d requests", len(texts), len(batch))
+            pos = 0
+            for (texts, future) in batch:
+                if not future.done():
+                    future.set_result(embeddings[pos:pos + len(texts)])
+                pos += len(texts)
+
+
+def local_models():
+    "The embedding functions of the models that run in-process"
+    from .embed import get_use4
+    return {BASE_EMBED_MODEL: get_use4()}
+
+
+async def serve(address=EMBED_SERVER):
+    batchers = {model: Batcher(embed) for (model, embed) in local_models().items()}
+
+    async def handle(reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    batcher = batchers.get(request['model'])
+                    if batcher is None:
+                        raise EmbedServerError(f"Model not served: {request['model']}")
+                    embeddings = await batcher.embed(request['texts'])
+                    response = dict(embeddings=[np.asarray(e).tolist() for e in embeddings])
+                except Exception as e:
+                    response = dict(error=str(e))
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    if tcp := parse_address(address):
+        server = await asyncio.start_server(handle, *tcp, limit=LINE_LIMIT)
+    else:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = await asyncio.start_unix_server(handle, address, limit=LINE_LIMIT)
+    logger.info("Serving %s on %s", ", ".join(batchers), address)
+    async with server:
+        await server.serve_forever()
+
+
+async def embed_remote(texts, model, address=EMBED_SERVER):
+    """Embed texts through the embedding server.
+
+    :raises OSError: if the server cannot be reached
+    :raises EmbedServerError: if the server could not embed the texts
+    """
+    if tcp := parse_address(address):
+        reader, writer = await asyncio.open_connection(*tcp, limit=LINE_LIMIT)
+    else:
+        reader, writer = await asyncio.open_unix_connection(address, limit=LINE_LIMIT)
+    try:
+        writer.write(json.dumps(dict(model=model, texts=texts)).encode('utf-8') + b'\n')
+        await writer.drain()
+        line = await reader.readline()
+    finally:
+        writer.close()
+    if not line:
+        raise ConnectionError("Embedding server closed the connection")
+    response = json.loads(line)
+    if 'error' in response:
+        raise EmbedServerError(response['error'])
+    return [np.array(e) for e in response['embeddings']]
+
+
+if __name__ == "__main__":
+    if not EMBED_SERVER:
+        raise SystemExit("Set the server address in the [embed] section of config.ini")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve())
@@ -0,0 +1,166 @@
+"""
+Garbage collection of the HashFS file store.
+Files are shared between documents with the same content, so they are only deleted when nothing refers to them:
+:py:func:`release_files` checks the references of the files a change dropped, and :py:func:`sweep` marks
+the files referenced by documents and unfinished bulk jobs, then deletes the others.
+Both only delete files past a grace period since they were last stored.
+:py:func:`usage_by_collection` reports the storage used by each collection.
+"""
+# Copyright Society Library and Conversence 2022-2023
+import argparse
+import asyncio
+import logging
+import os
+from time import time
+
+from sqlalchemy import select, union
+from sqlalchemy.sql.functions import func, count
+
+from . import Session, hashfs, config
+from .models import Document, DocCollection, Collection, BulkJob
+from .file_store import file_store
+
+logger = logging.getLogger("file_gc")
+
+GC_MIN_AGE = config.getint("files", "gc_min_age", fallback=24)
+"""Hours before an unreferenced file can be swept. Files are stored before the document that refers to them is committed."""
+
+
+def referencing_queries(ids=None):
+    "Queries for the file ids referenced by documents and unfinished bulk jobs, optionally among some ids"
+    queries = [
+        select(Document.file_identity.label('id')).filter(Document.file_identity != None),
+        select(Document.text_identity.label('id')).filter(Document.text_identity != None),
+        select(BulkJob.file_identity.label('id')).filter(BulkJob.status.in_(('pending', 'ongoing'))),
+    ]
+    if ids is not None:
+        queries = [q.filter(q.selected_columns.id.in_(ids)) for q in queries]
+    return queries
+
+
+async def referenced_ids(session, ids=None):
+    r = await session.execute(union(*referencing_queries(ids)))
+    return {id for (id,) in r}
+
+
+def file_age(id, fs=hashfs):
+    "Hours since the file was last stored, or None if it does not exist"
+    address = fs.get(id)
+    if address is None:
+        return None
+    return (time() - os.stat(address.abspath).st_mtime) / 3600
+
+
+async def release_files(session, *ids, min_age=GC_MIN_AGE):
+    """Delete the stored files that nothing refers to anymore, and that were not stored in the last min_age hours.
+    A recent file may be about to be referenced by a concurrent change that stored the same content;
+    it is left to the sweep. Call after committing the change that dropped the references.
+
+    :returns: the deleted ids
+    """
+    ids = {id for id in ids if id}
+    if not ids:
+        return set()
+    unreferenced = ids - await referenced_ids(session, list(ids))
+    ages = await file_store.run(lambda: {id: file_age(id) for id in unreferenced})
+    expired = {id for (id, age) in ages.items() if age is not None and age >= min_age}
+    await file_store.delete(*expired)
+    return expired
+
+
+def stored_files(fs=hashfs):
+    "Yields the id (None for stray temporary files), path, size and age in hours of every stored file"
+    now = time()
+    for path in fs.files():
+        stat = os.stat(path)
+        name = os.path.basename(path)
+        id = None if name.startswith('.tmp-') else fs.unshard(path)
+        yield id, path, stat.st_size, (now - stat.st_mtime) / 3600
+
+
+async def sweep(dry_run=True, min_age=GC_MIN_AGE, fs=hashfs):
+    """Delete the stored files that no document or unfinished bulk job refers to, and that are older than min_age hours.
+
+    :param dry_run: only report what would be deleted
+    :returns: a report of the files kept and (to be) deleted
+    """
+    async with Session() as session:
+        referenced = await referenced_ids(session)
+
+    def scan():
+        report = dict(files=0, bytes=0, referenced=0, missing=0, recent=0, orphans=0, orphan_bytes=0)
+        orphans = []
+        found = set()
+        for (id, path, size, age) in stored_files(fs):
+            report['files'] += 1
+            report['bytes'] += size
+            if id in referenced:
+                report['referenced'] += 1
+                found.add(id)
+            elif age < min_age:
+                report['recent'] += 1
+            else:
+                report['orphans'] += 1
+                report['orphan_bytes'] += size
+                orphans.append(path)
+        report['missing'] = len(referenced - found)
+        if not dry_run:
+            for path in orphans:
+                fs.delete(path)
+        report['deleted'] = 0 if dry_run else len(orphans)
+        return report, orphans
+
+    report, orphans = await file_store.run(scan)
+    logger.info("File sweep%s: %s", " (dry run)" if dry_run else "", report)
+    return report, orphans
+
+
+async def usage_by_collection():
+    """Storage used by the documents of each collection, counting each stored file once per collection.
+    Documents outside any collection are counted under None.
+
+    :returns: a list of dictionaries with the collection name, the number of documents, files and bytes
+    """
+    base = select(Document.id, DocCollection.collection_id).outerjoin(DocCollection, DocCollection.doc_id == Document.id)
+    files = union(
+        base.add_columns(Document.file_identity.label('file_id'), Document.file_size.label('size')
+                         ).filter(Document.file_identity != None),
+        base.add_columns(Document.text_identity.label('file_id'), Document.text_size.label('size')
+                         ).filter(Document.text_identity != None),
+    ).subquery()
+    per_file = select(files.c.collection_id, files.c.file_id, func.max(files.c.size).label('size')
+                      ).group_by(files.c.collection_id, files.c.file_id).subquery()
+    by_size = select(per_file.c.collection_id, count().label('files'), func.coalesce(func.sum(per_file.c.size), 0).label('bytes')
+                     ).group_by(per_file.c.collection_id).subquery()
+    by_docs = select(files.c.collection_id, count(files.c.id.distinct()).label('documents')
+                     ).group_by(files.c.collection_id).subquery()
+    q = select(Collection.name, by_docs.c.documents, by_size.c.files, by_size.c.bytes
+               ).select_from(by_size
+               ).join(by_docs, by_docs.c.collection_id.is_not_distinct_from(by_size.c.collection_id)
+               ).outerjoin(Collection, Collection.id == by_size.c.collection_id
+               ).order_by(by_size.c.bytes.desc())
+    async with Session() as session:
+        r = await session.execute(q)
+        return [row._asdict() for row in r]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sweep_parser = subparsers.add_parser("sweep", help="delete the unreferenced files (only reports them by default)")
+    sweep_parser.add_argument("--delete", action="store_true", help="actually delete the files")
+    sweep_parser.add_argument("--min_age", type=float, default=GC_MIN_AGE, help="hours before an unreferenced file is swept")
+    sweep_parser.add_argument("--list", action="store_true", help="list the unreferenced files")
+    subparsers.add_parser("usage", help="storage used by each collection")
+    args = parser.parse_args()
+    if args.command == "sweep":
+        report, orphans = asyncio.run(sweep(not args.delete, args.min_age))
+        if args.list:
+            for path in orphans:
+                print(path)
+        for (key, value) in report.items():
+            print(f"{key:<14} {value:>12}")
+    elif args.command == "usage":
+        print(f"{'collection':<24} {'documents':>10} {'files':>10} {'MB':>10}")
+        for row in asyncio.run(usage_by_collection()):
+            print(f"{str(row['name'] or '(none)'):<24} {row['documents']:>10} {row['files']:>10} {row['bytes'] / 1e6:>10.1f}")
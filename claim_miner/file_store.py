@@ -0,0 +1,236 @@
+"""
+Asynchronous access to the :py:data:`claim_miner.hashfs` content-addressed file store.
+Hashing and file I/O run in a dedicated thread pool, so that large files do not stall the event loop.
+Streams are written to a temporary file under the store root while they are hashed,
+then moved into place with an atomic rename, so the content is never held in memory.
+Storing content that is already there refreshes the modification time of its file, which the garbage collector
+takes as the start of a grace period.
+Recently read texts are kept in a size-bounded LRU; files never change once stored, so it needs no invalidation
+beyond deletion.
+"""
+# Copyright Society Library and Conversence 2022-2023
+import asyncio
+import hashlib
+import mmap
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from io import BytesIO
+from tempfile import NamedTemporaryFile
+
+from hashfs import HashAddress
+
+from . import hashfs, config
+
+FILE_THREADS = config.getint("files", "threads", fallback=8)
+TEXT_CACHE_MB = config.getint("files", "text_cache_mb", fallback=64)
+CHUNK_SIZE = 64 * 1024
+
+
+class FileTooLarge(ValueError):
+    pass
+
+
+class HashFSWriter():
+    """Writes a file into a HashFS store incrementally.
+    The temporary file lives in the store root, so that the final move is a rename on the same filesystem.
+
+    :param max_size: abort with :py:class:`FileTooLarge` beyond this many bytes (0 for no limit)
+    """
+
+    def __init__(self, fs=hashfs, max_size=0):
+        self.fs = fs
+        self.max_size = max_size
+        self.size = 0
+        self.hash = hashlib.new(fs.algorithm)
+        fs.makepath(fs.root)
+        self.file = NamedTemporaryFile('wb', dir=fs.root, prefix='.tmp-', delete=False)
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.max_size and self.size > self.max_size:
+            raise FileTooLarge(f"File larger than {self.max_size} bytes")
+        self.hash.update(chunk)
+        self.file.write(chunk)
+
+    def commit(self):
+        "Move the file into place, and return its :py:class:`hashfs.HashAddress`"
+        self.file.close()
+        id = self.hash.hexdigest()
+        filepath = self.fs.idpath(id)
+        is_duplicate = os.path.isfile(filepath)
+        if is_duplicate:
+            os.unlink(self.file.name)
+            os.utime(filepath)
+        else:
+            self.fs.makepath(os.path.dirname(filepath))
+            os.chmod(self.file.name, self.fs.fmode)
+            os.replace(self.file.name, filepath)
+        return HashAddress(id, self.fs.relpath(filepath), filepath, is_duplicate)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.file.name):
+            os.unlink(self.file.name)
+
+
+class TextCache():
+    "An LRU of texts, bounded by their total length"
+
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+        self.chars = 0
+        self.texts = OrderedDict()
+
+    def get(self, id):
+        text = self.texts.get(id)
+        if text is not None:
+            self.texts.move_to_end(id)
+        return text
+
+    def set(self, id, text):
+        if len(text) > self.max_chars // 4:
+            # Do not let one large document flush the cache
+            return
+        self.discard(id)
+        self.texts[id] = text
+        self.chars += len(text)
+        while self.chars > self.max_chars:
+            (_, old) = self.texts.popitem(last=False)
+            self.chars -= len(old)
+
+    def discard(self, id):
+        if (text := self.texts.pop(id, None)) is not None:
+            self.chars -= len(text)
+
+
+class AsyncFileStore():
+    """Coroutine versions of the HashFS operations, run in a thread pool.
+
+    :param threads: size of the thread pool
+    :param text_cache_mb: approximate size of the LRU of texts read with :py:meth:`read_text`
+    """
+
+    def __init__(self, fs=hashfs, threads=8, text_cache_mb=64):
+        self.fs = fs
+        self.threads = threads
+        self.text_cache = TextCache(text_cache_mb * 1024 * 1024)
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix="files")
+        return self._executor
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    def _put(self, content):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        if isinstance(content, bytes):
+            content = BytesIO(content)
+        address = self.fs.put(content)
+        if address.is_duplicate:
+            os.utime(address.abspath)
+        return address
+
+    async def put(self, content):
+        """Store content, given as bytes, a string (stored as utf-8) or a binary file object.
+
+        :returns: the :py:class:`hashfs.HashAddress` of the file
+        """
+        return await self.run(self._put, content)
+
+    async def put_many(self, contents):
+        """Store many small contents, a slice per thread rather than a thread hop per file.
+
+        :returns: their :py:class:`hashfs.HashAddress`, in order
+        """
+        contents = list(contents)
+        if not contents:
+            return []
+        slice_size = -(-len(contents) // self.threads)
+        slices = await asyncio.gather(*[
+            self.run(lambda part: [self._put(content) for content in part], contents[start:start + slice_size])
+            for start in range(0, len(contents), slice_size)])
+        return [address for part in slices for address in part]
+
+    async def put_stream(self, chunks, max_size=0):
+        """Store an async iterable of byte chunks, such as a download.
+
+        :returns: the :py:class:`hashfs.HashAddress` of the file
+        :raises FileTooLarge: if the stream exceeds max_size; nothing is stored
+        """
+        writer = await self.run(HashFSWriter, self.fs, max_size)
+        try:
+            async for chunk in chunks:
+                await self.run(writer.write, chunk)
+            return await self.run(writer.commit)
+        except BaseException:
+            await self.run(writer.abort)
+            raise
+
+    async def get(self, id):
+        "The :py:class:`hashfs.HashAddress` of a stored file, or None"
+        return await self.run(self.fs.get, id)
+
+    async def size(self, id):
+        "The size of a stored file, in bytes"
+        return await self.run(lambda: os.path.getsize(self.fs.idpath(id)))
+
+    async def read_bytes(self, id):
+        def read():
+            with self.fs.open(id) as f:
+                return f.read()
+        return await self.run(read)
+
+    async def read_text(self, id):
+        "The content of a stored text file, from the LRU if it was read recently"
+        text = self.text_cache.get(id)
+        if text is None:
+            text = (await self.read_bytes(id)).decode('utf-8')
+            self.text_cache.set(id, text)
+        return text
+
+    async def iter_bytes(self, id, chunk_size=CHUNK_SIZE):
+        "Stream the content of a stored file, chunk by chunk"
+        f = await self.run(self.fs.open, id)
+        try:
+            while chunk := await self.run(f.read, chunk_size):
+                yield chunk
+        finally:
+            await self.run(f.close)
+
+    @asynccontextmanager
+    async def mmap(self, id):
+        "Map a stored file in memory, read-only. Page faults still happen on access, so use it from a thread for large files."
+        def open_map():
+            with self.fs.open(id) as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        m = await self.run(open_map)
+        try:
+            yield m
+        finally:
+            m.close()
+
+    async def delete(self, *ids):
+        "Delete stored files; None ids are ignored"
+        ids = [id for id in ids if id]
+        for id in ids:
+            self.text_cache.discard(id)
+        if ids:
+            await self.run(lambda: [self.fs.delete(id) for id in ids])
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+file_store = AsyncFileStore(hashfs, FILE_THREADS, TEXT_CACHE_MB)
+"""The shared asynchronous file store"""
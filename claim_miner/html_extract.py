@@ -0,0 +1,163 @@
+"""
+Text and paragraph extraction from HTML documents, with selectable backends.
+The lxml backend streams the document through the parser without building a tree;
+the BeautifulSoup backend is kept as a fallback, and as a reference for the benchmark.
+"""
+# Copyright Society Library and Conversence 2022-2023
+import argparse
+import logging
+import re
+from pathlib import Path
+from time import perf_counter
+
+from . import config
+
+logger = logging.getLogger("html_extract")
+
+html_extractor = config.get("html", "extractor", fallback="lxml")
+"""Default backend: lxml or bs4"""
+CHUNK_SIZE = 64 * 1024
+SKIPPED_TAGS = {"script", "style", "template"}
+"""Elements whose contents are not text, as in BeautifulSoup's get_text"""
+
+
+def collapse_whitespace_and_paras(s):
+    s = re.sub(r'[ \t\f\v\xa0]+', ' ', s)
+    return re.sub(r'([ \t\f\v\xa0]?\n[ \t\f\v\xa0]?)+', '\n', s).strip()
+
+
+def collapse_whitespace_with_paras(s):
+    return re.sub(r'\s+', ' ', s).strip()
+
+
+def choose_paragraphs(text, paras):
+    "Use the <p> elements if they hold most of the text, otherwise split the text on newlines"
+    use_paras = sum(len(p) for p in paras) >= 0.8 * len(text)
+    if use_paras:
+        paras = [collapse_whitespace_with_paras(p) for p in paras]
+        text = '\n'.join(paras)
+    else:
+        text = collapse_whitespace_and_paras(text)
+        paras = text.split('\n')
+    return text, paras
+
+
+def extract_bs4(f):
+    "Extract the text and paragraphs of a HTML file object with BeautifulSoup"
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(f.read(), 'html.parser')
+    text = soup.get_text()
+    paras = [p.get_text() for p in soup.find_all('p')]
+    return choose_paragraphs(text, paras)
+
+
+class _TextTarget():
+    "lxml parser target collecting the document text, and the text of each <p> element"
+
+    def __init__(self):
+        self.parts = []
+        self.skipping = 0
+        self.paras = []
+        self.open_paras = []
+
+    def start(self, tag, attrib):
+        if tag in SKIPPED_TAGS:
+            self.skipping += 1
+        elif tag == 'p':
+            # Reserve the place of the paragraph, in document order
+            self.open_paras.append((len(self.paras), []))
+            self.paras.append(None)
+
+    def end(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skipping = max(self.skipping - 1, 0)
+        elif tag == 'p' and self.open_paras:
+            pos, parts = self.open_paras.pop()
+            self.paras[pos] = ''.join(parts)
+
+    def data(self, data):
+        if self.skipping:
+            return
+        self.parts.append(data)
+        for (_, parts) in self.open_paras:
+            parts.append(data)
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        for (pos, parts) in self.open_paras:
+            self.paras[pos] = ''.join(parts)
+        return ''.join(self.parts), self.paras
+
+
+def extract_lxml(f):
+    "Extract the text and paragraphs of a HTML file object, streaming it through lxml's parser"
+    from lxml import etree
+    parser = etree.HTMLParser(target=_TextTarget())
+    while chunk := f.read(CHUNK_SIZE):
+        parser.feed(chunk)
+    text, paras = parser.close()
+    return choose_paragraphs(text, paras)
+
+
+extractors = dict(lxml=extract_lxml, bs4=extract_bs4)
+
+
+def extract_html(path, extractor=None):
+    """Extract the text and paragraphs of a HTML file.
+    Falls back to BeautifulSoup if the chosen backend fails."""
+    extractor = extractor or html_extractor
+    try:
+        with open(path, 'r') as f:
+            return extractors[extractor](f)
+    except Exception as e:
+        if extractor == 'bs4':
+            raise
+        logger.warning("%s extraction failed for %s, using bs4: %s", extractor, path, e)
+    with open(path, 'r') as f:
+        return extract_bs4(f)
+
+
+def benchmark(paths, repeat=3):
+    """Compare the backends on a corpus of HTML files: throughput, and whether
+    the lxml paragraphs are identical to the bs4 ones."""
+    paths = [p for p in paths if p.is_file()]
+    total_bytes = sum(p.stat().st_size for p in paths)
+    results = {}
+    outputs = {}
+    for name, extractor in extractors.items():
+        times = []
+        for _ in range(repeat):
+            start = perf_counter()
+            outputs[name] = []
+            for path in paths:
+                with open(path, 'r') as f:
+                    outputs[name].append(extractor(f))
+            times.append(perf_counter() - start)
+        best = min(times)
+        results[name] = dict(seconds=best, mb_per_second=total_bytes / 1e6 / best if best else 0)
+    same = [lx[1] == bs[1] for (lx, bs) in zip(outputs['lxml'], outputs['bs4'])]
+    differing = [str(path) for (path, s) in zip(paths, same) if not s]
+    return dict(files=len(paths), megabytes=total_bytes / 1e6, backends=results,
+                identical=sum(same), differing=differing)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench_parser = subparsers.add_parser("benchmark", help="compare the extraction backends on saved HTML files")
+    bench_parser.add_argument("paths", nargs="+", type=Path, help="HTML files, or directories of HTML files")
+    bench_parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    if args.command == "benchmark":
+        paths = []
+        for path in args.paths:
+            paths.extend(sorted(path.rglob("*")) if path.is_dir() else [path])
+        r = benchmark(paths, args.repeat)
+        print(f"{r['files']} files, {r['megabytes']:.1f} MB")
+        for name, b in r['backends'].items():
+            print(f"{name:<8} {b['seconds']:>8.2f} s {b['mb_per_second']:>8.2f} MB/s")
+        print(f"Identical paragraphs: {r['identical']}/{r['files']}")
+        for path in r['differing']:
+            print(f"  differs: {path}")
@@ -0,0 +1,181 @@
+"""
+Bulk ingestion of documents and claims from uploaded files.
+Lines are parsed as they are read and handled in batches: one query finds the batch's known URLs or texts,
+the files are written to HashFS in the file store's thread pool, and each batch is committed on its own by the caller,
+so memory use does not depend on the size of the upload. See :py:mod:`claim_miner.tasks.bulk_upload`.
+"""
+# Copyright Society Library and Conversence 2022-2023
+import re
+
+import isodate
+import simplejson as json
+from sqlalchemy import select, update, func, literal, Integer, Text
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+
+from . import config, uri_equivalence
+from .file_store import file_store
+from .models import Document, UriEquiv, Fragment, FragmentCollection, fragment_type, standalone_types
+from .uri import normalize
+
+INGEST_BATCH_SIZE = config.getint("ingest", "batch_size", fallback=2000)
+PUBLISHED_FIELD = "date_published"
+GENERIC_CLAIM_TYPES = ('standalone', 'generated')
+"""Claim types that an upload with a more specific type replaces"""
+
+def compose_url_jsonl(data, spec):
+    if '|' in spec:
+        specs = spec.split('|')
+        for spec in specs:
+            if url := compose_url_jsonl(data, spec):
+                return url
+    part_specs = spec.split(',')
+    parts = []
+    for spec in part_specs:
+        spec = spec.strip()
+        if spec.startswith("'"):
+            parts.append(spec.strip("'"))
+            continue
+        slugify = spec.startswith("#")
+        spec = spec.strip("#")
+        prefix = None
+        if '-' in spec:
+            spec, prefix = spec.split('-')
+            prefix = int(prefix)
+        part = data.get(spec, None)
+        if slugify:
+            part = part.encode('ascii', 'replace').decode('ascii')
+            part = re.sub(r'\W+', "_", part, 0, re.ASCII)
+            part = part.strip('_')
+        if part == "n/a":
+            part = None
+        if not part:
+            return None
+        if prefix:
+            part = part[prefix:]
+        parts.append(part)
+    return "/".join(parts)
+
+
+def maybe_flatten(str_or_list):
+    if isinstance(str_or_list, list):
+        return "\n\n".join(str_or_list)
+    return str_or_list
+
+
+def get_text_jsonl(data, text_fields="text", text_process=None):
+    text_fields = text_fields.split(",")
+    text = "\n\n".join(maybe_flatten(data.get(field.strip(), "")) for field in text_fields)
+    if text_process:
+        for pat, repl in text_process:
+            text = re.sub(pat, repl, text)
+    return text
+
+
+def parse_published(published):
+    if not published or published == 'n/a':
+        return None
+    if ' ' in published:
+        published = 'T'.join(published.split())
+    if 'T' in published:
+        return isodate.parse_datetime(published)
+    return isodate.parse_date(published)
+
+
+def parse_jsonl_line(line, url_spec, text_fields="text", use_title=True, use_published=False, extra_newlines=False):
+    "Returns the url, text, title and publication date of a JSONL line, or None if it has no URL"
+    data = json.loads(line)
+    url = compose_url_jsonl(data, url_spec)
+    if not url:
+        return None
+    text = get_text_jsonl(data, text_fields, [[r" \n\n", " "]] if extra_newlines else None)
+    if isinstance(text, list):
+        text = "\n".join(text)
+    return dict(
+        url=normalize(url), text=text,
+        title=data.get("title") if use_title else None,
+        published=parse_published(data[PUBLISHED_FIELD]) if use_published else None)
+
+
+async def ingest_jsonl_batch(session, batch, collections, added_by):
+    """Add the documents of a batch of parsed JSONL lines whose URL is not known yet.
+    Returns the new documents and the number of duplicates. The caller commits."""
+    by_url = {}
+    for (line, item) in batch:
+        by_url.setdefault(item['url'], (line, item))
+    r = await session.execute(select(UriEquiv.uri).filter(UriEquiv.uri.in_(list(by_url))))
+    for (url,) in r:
+        del by_url[url]
+    # The original line and its text are stored for each document
+    contents = []
+    for (line, item) in by_url.values():
+        contents.extend((line.encode('utf-8'), item['text'].encode('utf-8')))
+    addresses = await file_store.put_many(contents)
+    docs = []
+    for (i, (line, item)) in enumerate(by_url.values()):
+        docs.append(Document(
+            uri=UriEquiv(uri=item['url']), added_by=added_by, title=item['title'], collections=list(collections),
+            file_identity=addresses[2 * i].id, file_size=len(contents[2 * i]),
+            text_identity=addresses[2 * i + 1].id, text_size=len(contents[2 * i + 1]),
+            mimetype='text/plain', created=item['published'], return_code=200))
+    session.add_all(docs)
+    await session.flush()
+    return docs, len(batch) - len(docs)
+
+
+async def ingest_urls_batch(session, urls, collections, added_by):
+    """Add documents for a batch of URLs that are not known yet; they still need to be downloaded.
+    Returns the new documents and the number of duplicates. The caller commits."""
+    uris, existing = await uri_equivalence.add_urls(session, urls)
+    docs = [Document(uri=uri, added_by=added_by, collections=list(collections)) for uri in uris]
+    session.add_all(docs)
+    await session.flush()
+    return docs, len(urls) - len(docs)
+
+
+async def ingest_claims_batch(session, texts, node_type, collections, added_by):
+    """Add the claims of a batch of texts that do not exist yet, with set-based queries.
+    Existing claims are added to the collections, and generic ones are given the uploaded type.
+    Returns the ids of the new claims and of the existing ones. The caller commits."""
+    texts = list(dict.fromkeys(texts))
+    existing = await find_claims(session, texts)
+    new_texts = [text for text in texts if text not in existing]
+    new_ids = []
+    if new_texts:
+        staged = func.unnest(literal(new_texts, ARRAY(Text))).table_valued("text", name="staged")
+        r = await session.execute(
+            insert(Fragment.__table__).from_select(
+                ['text', 'scale', 'language', 'char_position', 'position', 'created_by'],
+                select(
+                    staged.c.text, literal(node_type, fragment_type), literal('en'), literal(0), literal(0),
+                    literal(added_by, Integer))
+            ).on_conflict_do_nothing().returning(Fragment.__table__.c.id, Fragment.__table__.c.text))
+        inserted = {text: id for (id, text) in r}
+        new_ids = list(inserted.values())
+        # Created concurrently by another upload
+        if missing := [text for text in new_texts if text not in inserted]:
+            existing |= await find_claims(session, missing)
+    existing_ids = list(existing.values())
+    if existing_ids and node_type not in GENERIC_CLAIM_TYPES:
+        await session.execute(
+            update(Fragment.__table__).where(
+                Fragment.__table__.c.id.in_(existing_ids), Fragment.__table__.c.scale.in_(GENERIC_CLAIM_TYPES)
+            ).values(scale=node_type))
+    for collection in collections:
+        if ids := new_ids + existing_ids:
+            await session.execute(
+                insert(FragmentCollection.__table__).from_select(
+                    ['fragment_id', 'collection_id'],
+                    select(func.unnest(literal(ids, ARRAY(Integer))), literal(collection.id, Integer))
+                ).on_conflict_do_nothing())
+    return new_ids, existing_ids
+
+
+async def find_claims(session, texts):
+    "Returns a dictionary of existing claim ids by text, joining the texts with the fragment text hash index"
+    staged = func.unnest(literal(texts, ARRAY(Text))).table_valued("text", name="staged")
+    r = await session.execute(
+        select(func.min(Fragment.id), Fragment.text
+        ).join(staged, staged.c.text == Fragment.text
+        ).filter(Fragment.doc_id == None, Fragment.scale.in_(standalone_types)
+        ).group_by(Fragment.text))
+    return {text: id for (id, text) in r}
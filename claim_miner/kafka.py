@@ -14,6 +14,7 @@ CONSUMER = None
 PRODUCER = None
 
 topics = [
+    "bulk_upload",
     "debatemap",
     "download",
     "embed",
@@ -38,7 +39,7 @@ async def get_consumer():
             *topics,
             bootstrap_servers=f"{config.get('kafka', 'host', fallback='localhost')}:{config.get('kafka', 'port', fallback=9092)}",
             value_deserializer=deserializer, key_deserializer=deserializer,
-            group_id='ClaimMiner')
+            group_id='ClaimMiner', enable_auto_commit=False)
         await CONSUMER.start()
         logger.info("Consumer ready")
     return CONSUMER
@@ -49,7 +50,10 @@ async def get_producer():
     if PRODUCER is None:
         PRODUCER = aiokafka.AIOKafkaProducer(
             bootstrap_servers=f"{config.get('kafka', 'host', fallback='localhost')}:{config.get('kafka', 'port', fallback=9092)}",
-            value_serializer=serializer, key_serializer=serializer)
+            value_serializer=serializer, key_serializer=serializer,
+            # Let records accumulate briefly, so bulk sends go out as a few compressed batches
+            linger_ms=int(config.get('kafka', 'linger_ms', fallback=20)),
+            compression_type=config.get('kafka', 'compression', fallback='gzip') or None)
         await PRODUCER.start()
         logger.info("Producer ready")
     return PRODUCER
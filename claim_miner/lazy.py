@@ -0,0 +1,123 @@
+"""
+Heavy resources (models, API clients, connections) created on first use rather than at import time,
+so that web and worker processes only pay for the features they use, and start fast.
+Resources are registered by name; their creation time is recorded, and the command line reports it
+along with the import time of the modules, as measured by ``python -X importtime``.
+"""
+# Copyright Society Library and Conversence 2022-2023
+import argparse
+import logging
+import subprocess
+import sys
+from threading import Lock
+from time import perf_counter
+
+from . import config
+
+PRELOAD = config.get("base", "preload", fallback="").split()
+"""Resources to create when a process starts, rather than on first use"""
+
+logger = logging.getLogger("lazy")
+
+resources = {}
+"""The registered resources, by name"""
+
+
+class LazyResource():
+    """A resource created by its factory on first use. Creation is thread-safe.
+
+    :param factory: a function without arguments returning the resource (possibly None, if not configured)
+    """
+
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self.loaded = False
+        self.seconds = None
+        self._value = None
+        self._lock = Lock()
+
+    def get(self):
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    start = perf_counter()
+                    self._value = self.factory()
+                    self.seconds = perf_counter() - start
+                    self.loaded = True
+                    logger.info("Loaded %s in %.2f s", self.name, self.seconds)
+        return self._value
+
+    def reset(self):
+        with self._lock:
+            self._value = None
+            self.loaded = False
+
+
+def lazy_resource(name):
+    "Decorator registering a factory function as a :py:class:`LazyResource`"
+    def decorator(factory):
+        resource = LazyResource(name, factory)
+        resources[name] = resource
+        return resource
+    return decorator
+
+
+def preload(*names):
+    "Create resources ahead of use, e.g. to warm up a process before it takes traffic. Defaults to all."
+    for name in names or list(resources):
+        if name in resources:
+            resources[name].get()
+        else:
+            logger.warning("Unknown resource: %s", name)
+
+
+def resource_report():
+    return [dict(name=r.name, loaded=r.loaded, seconds=r.seconds) for r in resources.values()]
+
+
+def import_times(module, python=sys.executable):
+    """Import a module in a fresh interpreter with ``-X importtime``.
+
+    :returns: the total import time in seconds, and (cumulative seconds, self seconds, module) for each imported module
+    """
+    r = subprocess.run([python, "-X", "importtime", "-c", f"import {module}"],
+                       capture_output=True, text=True)
+    if r.returncode:
+        raise RuntimeError(f"Could not import {module}:\n{r.stderr[-2000:]}")
+    times = []
+    for line in r.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times.append((int(cumulative_us) / 1e6, int(self_us) / 1e6, name.rstrip()))
+    # Nested imports are indented; the top level ones add up to the total
+    indent = min((len(name) - len(name.lstrip()) for (_, _, name) in times), default=0)
+    total = sum(cumulative for (cumulative, _, name) in times if len(name) - len(name.lstrip()) == indent)
+    return total, times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("importtime", help="report the slowest imports of an entry point")
+    import_parser.add_argument("modules", nargs="*", default=["claim_miner.app_full", "claim_miner.tasks.kafka"])
+    import_parser.add_argument("--top", type=int, default=20)
+    load_parser = subparsers.add_parser("load", help="report the creation time of the lazy resources")
+    load_parser.add_argument("modules", nargs="*", default=["claim_miner.app_full", "claim_miner.tasks.kafka"],
+                             help="modules registering the resources")
+    load_parser.add_argument("--resources", nargs="*", default=[])
+    args = parser.parse_args()
+    if args.command == "importtime":
+        for module in args.modules:
+            total, times = import_times(module)
+            print(f"{module}: {total:.2f} s")
+            for (cumulative, self_time, name) in sorted(times, reverse=True)[:args.top]:
+                print(f"  {cumulative:>8.3f} {self_time:>8.3f}  {name}")
+    elif args.command == "load":
+        from importlib import import_module
+        for module in args.modules:
+            import_module(module)
+        preload(*args.resources)
+        for r in resource_report():
+            print(f"{r['name']:<24} {r['seconds'] or 0:>8.2f} s")
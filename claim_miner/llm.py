@@ -4,13 +4,19 @@ Copyright Society Library and Conversence 2022-2023
 from typing import List, Dict, Optional
 import re
 
-from redis import Redis
-import langchain
-from langchain.cache import RedisCache
-from langchain.llms import OpenAI
 from langchain.schema import BaseOutputParser
 
-langchain.llm_cache = RedisCache(Redis(db=6))
+from .lazy import lazy_resource
+
+
+@lazy_resource("llm_cache")
+def llm_cache():
+    "Cache the LLM answers in redis"
+    from redis import Redis
+    import langchain
+    from langchain.cache import RedisCache
+    langchain.llm_cache = RedisCache(Redis(db=6))
+    return langchain.llm_cache
 
 
 models = {
@@ -26,6 +32,8 @@ DEFAULT_MODEL = "text-davinci-003"
 
 
 def get_base_llm(model_name=DEFAULT_MODEL, temperature=0):
+    from langchain.llms import OpenAI
+    llm_cache.get()
     return OpenAI(model_name=model_name, n=2, best_of=2, temperature=temperature)
 
 
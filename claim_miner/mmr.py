@@ -0,0 +1,99 @@
+"""
+Maximal marginal relevance (MMR) search, computed in the application.
+Candidates are fetched with the search query itself, so they are already scoped to the collection;
+the selection is incremental, so it can be kept as a search window and extended by later pages.
+"""
+# Copyright Society Library and Conversence 2022-2023
+import numpy as np
+from sqlalchemy import cast, REAL
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from . import config
+
+MMR_CANDIDATES = config.getint("search", "mmr_candidates", fallback=1000)
+
+
+class MMRSelector():
+    """Incremental MMR selection over a fixed set of candidates.
+
+    :param ids: the candidate ids
+    :param embeddings: the candidates' embeddings, as a 2D array
+    :param similarities: the candidates' similarity to the query
+    :param lam: the tradeoff between relevance (1) and diversity (0)
+    :param complete: whether there are no candidates beyond these
+    """
+
+    def __init__(self, ids, embeddings, similarities, lam, complete=True):
+        # Skip leading candidates that are identical to the query
+        start = 0
+        while start < len(similarities) and similarities[start] > 0.999:
+            start += 1
+        self.ids = ids[start:]
+        embeddings = np.asarray(embeddings[start:], dtype=np.float32)
+        if not len(self.ids):
+            embeddings = np.zeros((0, 1), dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.embeddings = embeddings / np.where(norms > 0, norms, 1)
+        self.similarities = np.asarray(similarities[start:], dtype=np.float32)
+        self.lam = lam
+        self.complete = complete
+        self.max_selected_similarity = np.full(len(self.ids), -1, dtype=np.float32)
+        self.available = np.ones(len(self.ids), dtype=bool)
+        self.selected = []
+        self.scores = []
+
+    def extend(self, n):
+        "Extend the selection to n items, or as many as there are candidates"
+        n = min(n, len(self.ids))
+        while len(self.selected) < n:
+            if self.selected:
+                mmr_scores = self.similarities * self.lam - self.max_selected_similarity * (1 - self.lam)
+            else:
+                mmr_scores = self.similarities.copy()
+            mmr_scores[~self.available] = -np.inf
+            pos = int(np.argmax(mmr_scores))
+            self.selected.append(pos)
+            self.scores.append(float(mmr_scores[pos]))
+            self.available[pos] = False
+            np.maximum(self.max_selected_similarity, self.embeddings @ self.embeddings[pos], out=self.max_selected_similarity)
+
+    def covers(self, offset, limit):
+        return self.complete or offset + limit <= len(self.ids)
+
+    def page(self, offset, limit):
+        "The ids and MMR scores of the selection between offset and offset + limit"
+        self.extend(offset + limit)
+        return [(self.ids[pos], score) for (pos, score) in zip(
+            self.selected[offset:offset+limit], self.scores[offset:offset+limit])]
+
+
+async def mmr_window(session, query, id_column, embedding_column, distance, lam, exact=False):
+    """Prepare a MMR selection over the candidates given by a query.
+    An index scan gives as many candidates as the ANN parameters allow.
+
+    :param query: a scoped query for the rows to display, including the embedding table
+    :param id_column: the fragment id column of that query
+    :param embedding_column: the embedding column of that query
+    :param distance: the distance between that column and the query embedding
+    :param exact: whether the search runs without the ANN indexes, so that fewer candidates are all of them
+    """
+    q = query.with_only_columns(
+        id_column, distance,
+        # real[] is decoded natively by the driver
+        cast(embedding_column, ARRAY(REAL))
+    ).order_by(distance).limit(MMR_CANDIDATES)
+    r = await session.execute(q)
+    rows = r.all()
+    ids = []
+    embeddings = []
+    similarities = []
+    seen = set()
+    for (id, distance, embedding) in rows:
+        # Joins on collections may repeat a fragment
+        if id in seen:
+            continue
+        seen.add(id)
+        ids.append(id)
+        similarities.append(1.0 - distance)
+        embeddings.append(embedding)
+    return MMRSelector(ids, embeddings, similarities, lam, exact and len(rows) < MMR_CANDIDATES)
@@ -45,13 +45,13 @@ permission = ENUM('admin',
     name='permission')
 """The enum of permissions that a user can have, related to specific tasks"""
 
-# Unused
 process_status = ENUM(
     'pending',
     'ongoing',
     'complete',
     'error',
     name='process_status')
+"""The enum of states of a background process"""
 
 standalone_type_names = {
   'reified_arg_link': "Empty Argument",  #: Argument wrapper
@@ -196,24 +196,12 @@ class CollectionScope():
             return globalScope
         if isinstance(name, CollectionScope):
             return name
-        if not session:
-            from . import Session
-            async with Session() as session:
-                return await CollectionScope.get_collection(name, session, user_id)
-        q = select(Collection).filter_by(name=name).limit(1)
+        from .collection_cache import load_collection, attach, detached_copy
+        cached, permissions = await load_collection(name, user_id, session)
+        collection = await attach(session, cached) if session else detached_copy(cached)
         if user_id:
-            q = q.outerjoin(
-                CollectionPermissions,
-                (CollectionPermissions.collection_id == Collection.id) &
-                (CollectionPermissions.user_id == user_id)
-                ).add_columns(CollectionPermissions)
-        r = await session.execute(q)
-        r = r.first()
-        if not r:
-            raise ValueError("Unknown collection: ", name)
-        collection = r[0]
-        if user_id:
-            collection.user_permissions = r[1]
+            collection.user_permissions = None if permissions is None else CollectionPermissions(
+                user_id=user_id, collection_id=collection.id, permissions=permissions)
         return collection
 
     @staticmethod
@@ -235,8 +223,8 @@ class CollectionScope():
 
     @staticmethod
     async def get_collection_names(session):
-        r = await session.execute(select(Collection.name))
-        return [n for (n,) in r]
+        from .collection_cache import get_collection_names
+        return await get_collection_names(session)
 
 
 class Collection(Base, CollectionScope):
@@ -515,6 +503,33 @@ class ClaimLink(Base):
     target_fragment = relationship(Fragment, foreign_keys=[target], backref="incoming_links")
 
 
+class BulkJob(Base):
+    """A bulk upload, processed in the background by the worker.
+    Progress is committed with each batch, so an interrupted job resumes after the last committed line
+    and re-sends the followup messages of that batch."""
+    __tablename__ = 'bulk_job'
+    id = Column(Integer, primary_key=True)  #: Primary key
+    kind = Column(String, nullable=False)  #: What is uploaded: docs_csv, docs_jsonl or claims_csv
+    status = Column(process_status, nullable=False, server_default='pending')
+    file_identity = Column(String, nullable=False)  #: The uploaded file, refers to HashFS
+    params = Column(JSONB, nullable=False, server_default='{}')  #: Upload form parameters
+    collection_id = Column(Integer, ForeignKey(Collection.id))  #: The collection receiving the upload
+    added_by = Column(Integer, ForeignKey(User.id))  #: Who uploaded the file
+    created = Column(DateTime, server_default='now()', nullable=False)
+    updated = Column(DateTime, server_default='now()', nullable=False)
+    lines_done = Column(Integer, nullable=False, server_default='0')  #: Lines of the file handled and committed
+    pending_ids = Column(ARRAY(Integer))  #: New items of the last committed batch, whose followup messages may not have been sent
+    progress = Column(JSONB, nullable=False, server_default='{}')  #: Counts of added and duplicate items
+    error = Column(Text)
+
+    collection = relationship(Collection)
+
+    def as_dict(self):
+        return dict(
+            id=self.id, kind=self.kind, status=self.status, created=self.created.isoformat(),
+            updated=self.updated.isoformat(), lines_done=self.lines_done, progress=self.progress, error=self.error)
+
+
 async def claim_neighbourhood(nid: int, session):
     children = select(
         ClaimLink.target.label('id'), Fragment.scale, literal_column("'child'").label('level')
@@ -3,35 +3,64 @@ Copyright Society Library and Conversence 2022-2023
 """
 import re
 
-import spacy
-
 from . import config
+from .lazy import lazy_resource
 
-nlp = spacy.load(config.get("base", "spacy_model", fallback="en_core_web_sm"))
+SPACY_MODEL = config.get("base", "spacy_model", fallback="en_core_web_sm")
+NLP_BATCH_SIZE = config.getint("nlp", "batch_size", fallback=64)
+NLP_PROCESSES = config.getint("nlp", "processes", fallback=1)
+SPLIT_PIPES = ("sentencizer",)
+"""Components needed to split sentences: a rule-based sentencizer"""
+PARSE_PIPES = ("tok2vec", "parser")
+"""Components needed for the dependency trees of the pivot patterns"""
 
 
-def breakup_para(para, limit=999):
-    if len(para) > limit:
-        chunks = []
-        offset = 0
-        nlp_analysis = nlp(para)
-        sents = list(nlp_analysis.sents)
-        for s in sents:
-            if s.end_char - offset > limit:
-                end = s.start_char
-                chunks.append(para[offset:end])
-                offset = end
-        chunks.append(para[offset:])
-    else:
-        chunks = [para]
+@lazy_resource("spacy")
+def spacy_pipeline():
+    "The spaCy pipeline, without the components we never use"
+    import spacy
+    nlp = spacy.load(SPACY_MODEL, exclude=["ner", "lemmatizer"])
+    nlp.add_pipe("sentencizer")
+    return nlp
+
+
+def get_nlp():
+    return spacy_pipeline.get()
+
+
+def pipe(texts, components, batch_size=None, n_process=None):
+    """Analyse texts in batches, running only the given components. Yields the docs in order, as they are ready."""
+    nlp = get_nlp()
+    disable = [name for name in nlp.pipe_names if name not in components]
+    return nlp.pipe(texts, disable=disable, batch_size=batch_size or NLP_BATCH_SIZE, n_process=n_process or NLP_PROCESSES)
+
+
+def split_at_sentences(text, sents, limit):
+    "Cut text into chunks of at most limit characters, at sentence boundaries where possible"
+    chunks = []
+    offset = 0
+    for s in sents:
+        if s.end_char - offset > limit and s.start_char > offset:
+            chunks.append(text[offset:s.start_char])
+            offset = s.start_char
+    chunks.append(text[offset:])
     return chunks
 
 
+def breakup_para(para, limit=999):
+    return breakup_paras([para], limit)
+
+
 def breakup_paras(paras, limit=999):
+    "Cut the paragraphs longer than limit at sentence boundaries. The long paragraphs are analysed together."
+    paras = list(paras)
+    long_paras = [para for para in paras if len(para) > limit]
+    # Processes only pay off for many paragraphs
+    analyses = iter(pipe(long_paras, SPLIT_PIPES, n_process=1 if len(long_paras) < NLP_BATCH_SIZE else None))
     chunks = []
     for para in paras:
         if len(para) > limit:
-            chunks.extend(breakup_para(para, limit=limit))
+            chunks.extend(split_at_sentences(para, next(analyses).sents, limit))
         else:
             chunks.append(para)
     return chunks
@@ -40,15 +69,8 @@ def breakup_paras(paras, limit=999):
 def breakup_sentences(txt, limit=999):
     # For text that does not have paragraphs
     txt = re.sub(r'[\n\s]+', ' ', txt)
-    nlp_analysis = nlp(txt)
-    chunks = []
-    offset = 0
-    sents = list(nlp_analysis.sents)
-    for s in sents:
-        if s.end_char - offset > limit:
-            end = s.start_char
-            chunks.append(txt[offset:end])
-            offset = end
+    (nlp_analysis,) = pipe([txt], SPLIT_PIPES, n_process=1)
+    return split_at_sentences(txt, nlp_analysis.sents, limit)
 
 
 min_wlen = 12
@@ -92,8 +114,7 @@ def roots(ana):
     return [t for t in ana if t.dep_=='ROOT']
 
 
-def as_prompts(para):
-    ana = nlp(para)
+def prompts_of(ana):
     for r in roots(ana):
         if r.right_edge.i - r.left_edge.i < min_wlen:
             continue
@@ -101,6 +122,17 @@ def as_prompts(para):
         yield (ana[r.left_edge.i : pos].text, ana[pos : r.right_edge.i+1].text)
 
 
+def as_prompts(para):
+    (ana,) = pipe([para], PARSE_PIPES, n_process=1)
+    return prompts_of(ana)
+
+
+def iter_prompts(paras, batch_size=None, n_process=None):
+    "Yields the list of (prompt, completion) pairs of each paragraph, parsing the paragraphs in batches"
+    for ana in pipe(paras, PARSE_PIPES, batch_size, n_process):
+        yield list(prompts_of(ana))
+
+
 def print_tree(ana, r, indent=0, direction=''):
     before = True
     children = list(r.children)
@@ -0,0 +1,137 @@
+"""
+Cached windows of ranked search results.
+The first request of a search ranks a window of fragment ids, and later pages are sliced from it,
+without embedding the query or scanning the index again. Windows are identified by an opaque cursor.
+"""
+# Copyright Society Library and Conversence 2022-2023
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from collections import OrderedDict, defaultdict
+from hashlib import sha256
+from secrets import token_bytes
+from time import monotonic
+
+import simplejson as json
+
+from . import config
+
+SEARCH_WINDOW = config.getint("search", "window_size", fallback=1000)
+SEARCH_CACHE_TTL = config.getint("search", "cache_ttl", fallback=600)
+SEARCH_CACHE_SIZE = config.getint("search", "cache_size", fallback=100)
+
+_secret = token_bytes(16)
+_windows = OrderedDict()
+
+
+class RankedWindow():
+    """The first ids of a ranked search, with their scores.
+
+    :param complete: whether the search had no results beyond the window
+    """
+
+    def __init__(self, ids, scores, complete):
+        self.ids = ids
+        self.scores = scores
+        self.complete = complete
+
+    def covers(self, offset, limit):
+        return self.complete or offset + limit <= len(self.ids)
+
+    def page(self, offset, limit):
+        "The ids and scores between offset and offset + limit"
+        return list(zip(self.ids[offset:offset+limit], self.scores[offset:offset+limit]))
+
+
+class SearchEntry():
+    def __init__(self, window, owner=None, params=None):
+        self.window = window
+        self.owner = owner
+        self.params = params
+        self.expiry = monotonic() + SEARCH_CACHE_TTL
+
+
+def search_token(key):
+    "A token for the search key, which does not reveal the key"
+    return sha256(_secret + repr(key).encode('utf-8')).hexdigest()[:32]
+
+
+def get_window(token, owner=None):
+    "The cached search entry for that token, if it exists, is current and belongs to that owner"
+    entry = _windows.get(token)
+    if entry is None:
+        return None
+    if entry.expiry < monotonic() or entry.owner != owner:
+        if entry.expiry < monotonic():
+            del _windows[token]
+        return None
+    _windows.move_to_end(token)
+    return entry
+
+
+def set_window(token, window, owner=None, params=None):
+    _windows[token] = SearchEntry(window, owner, params)
+    _windows.move_to_end(token)
+    while len(_windows) > SEARCH_CACHE_SIZE:
+        _windows.popitem(last=False)
+
+
+def make_cursor(token, offset, limit):
+    return urlsafe_b64encode(json.dumps([token, offset, limit]).encode('ascii')).decode('ascii')
+
+
+def parse_cursor(cursor):
+    "Returns the token, offset and limit of a cursor; raises ValueError if malformed"
+    try:
+        token, offset, limit = json.loads(urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not (isinstance(token, str) and isinstance(offset, int) and isinstance(limit, int)):
+        raise ValueError("Invalid cursor")
+    return token, offset, limit
+
+
+async def rank_window(session, query, id_column, distance, min_size=0, exact=False):
+    """Rank the ids of the rows of a scoped query by distance, up to the window size.
+    An index scan returns as many rows as the ANN parameters allow, which may be fewer;
+    later pages beyond them rank again with a larger scan.
+
+    :param query: the query for the rows to display
+    :param id_column: the fragment id column of that query
+    :param distance: the distance to the search target, lower ranks first
+    :param min_size: enlarge the window for pages beyond the usual size
+    :param exact: whether the search runs without the ANN indexes, so that a short result is complete
+    """
+    size = max(SEARCH_WINDOW, min_size)
+    q = query.with_only_columns(id_column, distance).order_by(distance).limit(size)
+    r = await session.execute(q)
+    rows = r.all()
+    ids = []
+    scores = []
+    seen = set()
+    for (id, score) in rows:
+        # Joins on collections may repeat a fragment
+        if id in seen:
+            continue
+        seen.add(id)
+        ids.append(id)
+        scores.append(score)
+    return RankedWindow(ids, scores, exact and len(rows) < size)
+
+
+async def fetch_page(session, query, id_column, window, offset, limit, score_label='rank'):
+    """Fetch the rows of a page of the window, in window order.
+    An id may have several rows, e.g. one per linked claim; identical rows, as from joins on collections, are merged.
+
+    :returns: a list of dictionaries, with the score as `score_label`
+    """
+    page = window.page(offset, limit)
+    if not page:
+        return []
+    r = await session.execute(query.add_columns(id_column.label('window_id')).filter(
+        id_column.in_([id for (id, _) in page])))
+    rows = defaultdict(list)
+    for row in r:
+        row = row._asdict()
+        id_rows = rows[row.pop('window_id')]
+        if row not in id_rows:
+            id_rows.append(row)
+    return [row | {score_label: score} for (id, score) in page for row in rows.get(id, ())]
@@ -0,0 +1,92 @@
+"""
+Segmentation of document texts into paragraph fragments.
+When a document is processed again, the new paragraphs are matched with the existing fragments by text,
+so that unchanged paragraphs keep their fragment, with its embeddings and analyses;
+only the fragments of changed paragraphs are inserted or deleted.
+New fragments are written with multi-row inserts rather than through the ORM unit of work.
+"""
+# Copyright Society Library and Conversence 2022-2023
+from collections import defaultdict
+
+from sqlalchemy import select, delete, update, insert, bindparam
+
+from .models import Fragment, embed_models
+
+MIN_PARAGRAPH_LENGTH = 120
+INSERT_BATCH_SIZE = 5000
+"""Rows per insert statement, within the limit of 32767 query parameters"""
+
+
+def paragraph_positions(paras, min_length=MIN_PARAGRAPH_LENGTH):
+    "Yields the position, character position and text of the paragraphs long enough to be fragments"
+    char_pos = 0
+    for (para_pos, para) in enumerate(paras):
+        if len(para) >= min_length:
+            yield para_pos, char_pos, para
+        char_pos += 1 + len(para)
+
+
+def match_paragraphs(old, new):
+    """Match new paragraphs with old fragments of the same text, preferring the closest position.
+
+    :param old: (id, position, char_position, text) of the existing fragments
+    :param new: (position, char_position, text) of the new paragraphs
+    :returns: a list of (id or None, new paragraph), and the ids of the unmatched old fragments
+    """
+    by_text = defaultdict(list)
+    for row in old:
+        by_text[row[3]].append(row)
+    matches = []
+    for para in new:
+        candidates = by_text.get(para[2])
+        if candidates:
+            best = min(candidates, key=lambda row: abs(row[1] - para[0]))
+            candidates.remove(best)
+            matches.append((best, para))
+        else:
+            matches.append((None, para))
+    unmatched = [row[0] for rows in by_text.values() for row in rows]
+    return matches, unmatched
+
+
+async def resegment(session, doc, paras, text_changed=True):
+    """Update the paragraph fragments of a document to match its new paragraphs.
+    Does not commit.
+
+    :param text_changed: whether the document text changed, which makes its document-level embeddings obsolete
+    :returns: the ids of the new fragments, which need embeddings
+    """
+    r = await session.execute(
+        select(Fragment.id, Fragment.position, Fragment.char_position, Fragment.text
+               ).filter_by(doc_id=doc.id, scale='paragraph'))
+    matches, unmatched = match_paragraphs(list(r), list(paragraph_positions(paras)))
+    if unmatched:
+        # Cascades to the embeddings, the analysis contexts and the sub-fragments
+        await session.execute(delete(Fragment).where(Fragment.id.in_(unmatched)))
+    moved = [dict(f_id=old[0], new_position=new[0], new_char_position=new[1])
+             for (old, new) in matches if old and (old[1], old[2]) != new[:2]]
+    if moved:
+        await session.execute(
+            update(Fragment.__table__).where(Fragment.__table__.c.id == bindparam('f_id')).values(
+                position=bindparam('new_position'), char_position=bindparam('new_char_position')),
+            moved)
+    if text_changed:
+        for Embedding in embed_models.values():
+            await session.execute(delete(Embedding).where(Embedding.doc_id == doc.id, Embedding.fragment_id == None))
+    return await insert_paragraphs(session, doc.id, doc.language, [new for (old, new) in matches if old is None])
+
+
+async def insert_paragraphs(session, doc_id, language, paras):
+    """Insert paragraph fragments. Does not commit.
+
+    :param paras: (position, char_position, text) of the paragraphs
+    :returns: the ids of the new fragments, in order
+    """
+    ids = []
+    for start in range(0, len(paras), INSERT_BATCH_SIZE):
+        rows = [dict(doc_id=doc_id, position=para_pos, char_position=char_pos, text=text,
+                     scale='paragraph', language=language)
+                for (para_pos, char_pos, text) in paras[start:start + INSERT_BATCH_SIZE]]
+        r = await session.execute(insert(Fragment.__table__).values(rows).returning(Fragment.__table__.c.id))
+        ids.extend(id for (id,) in r)
+    return ids
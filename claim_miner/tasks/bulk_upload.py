@@ -0,0 +1,117 @@
+"""
+Bulk uploads of documents and claims, run as background jobs.
+Each batch is committed together with the job's progress and the ids that still need followup messages,
+so a job interrupted by a worker crash re-sends those messages and resumes after the last committed batch
+when its message is delivered again.
+"""
+# Copyright Society Library and Conversence 2022-2023
+from csv import reader
+from datetime import datetime
+from itertools import islice
+
+from .. import Session
+from ..file_store import file_store
+from ..models import BulkJob, Collection
+from ..kafka import get_channel
+from ..ingest import parse_jsonl_line, ingest_jsonl_batch, ingest_urls_batch, ingest_claims_batch, INGEST_BATCH_SIZE
+from . import logger, schedule_fragment_embeds
+
+
+def read_items(job, f):
+    "Yields an item per line (or CSV row) of the uploaded file, or None for unusable lines"
+    params = job.params
+    if job.kind == 'docs_jsonl':
+        options = {k: params[k] for k in ('url_spec', 'text_fields', 'use_title', 'use_published', 'extra_newlines') if k in params}
+        for line in f:
+            try:
+                item = parse_jsonl_line(line, **options) if line.strip() else None
+            except ValueError:
+                item = None
+            yield (line, item) if item else None
+    else:
+        column = params['column']
+        for (row_num, row) in enumerate(reader(f)):
+            if row_num == 0 and params.get('skip'):
+                yield None
+                continue
+            text = row[column].strip() if len(row) > column else ''
+            if job.kind == 'docs_csv' and not text.startswith("http"):
+                text = ''  # basic sanity check
+            yield text or None
+
+
+async def ingest_items(session, job, items, collections):
+    "Ingest a batch of items. Returns the ids of the new documents or claims, and the number of duplicates"
+    if job.kind == 'docs_jsonl':
+        docs, duplicates = await ingest_jsonl_batch(session, items, collections, job.added_by)
+        return [doc.id for doc in docs], duplicates
+    elif job.kind == 'docs_csv':
+        docs, duplicates = await ingest_urls_batch(session, items, collections, job.added_by)
+        return [doc.id for doc in docs], duplicates
+    elif job.kind == 'claims_csv':
+        new_ids, existing_ids = await ingest_claims_batch(session, items, job.params['node_type'], collections, job.added_by)
+        return new_ids, len(items) - len(new_ids)
+    raise ValueError(f"Unknown job kind: {job.kind}")
+
+
+async def schedule_followup(job, new_ids, collections):
+    if job.kind == 'claims_csv':
+        await schedule_fragment_embeds(new_ids, collections)
+        return
+    channel = get_channel("process_text" if job.kind == 'docs_jsonl' else "download")
+    for doc_id in new_ids:
+        await channel.send_soon(key=str(doc_id), value=doc_id)
+
+
+async def do_bulk_upload(job_id):
+    async with Session() as session:
+        job = await session.get(BulkJob, job_id)
+        if job is None:
+            logger.error(f"Missing bulk job {job_id}")
+            return
+        if job.status in ('complete', 'error'):
+            return
+        if job.lines_done:
+            logger.info("Resuming bulk job %d after line %d", job_id, job.lines_done)
+        collections = [await session.get(Collection, job.collection_id)] if job.collection_id else []
+        job.status = 'ongoing'
+        job.updated = datetime.utcnow()
+        await session.commit()
+        if job.pending_ids:
+            # The worker may have stopped before sending the last committed batch's messages
+            await schedule_followup(job, job.pending_ids, collections)
+        progress = dict(added=0, duplicates=0, invalid=0) | job.progress
+        try:
+            file_info = await file_store.get(job.file_identity)
+            newline = '' if job.kind.endswith('_csv') else None
+            with open(file_info.abspath, encoding='utf-8', newline=newline) as f:
+                items = read_items(job, f)
+                # Skip what was committed before an interruption
+                for _ in islice(items, job.lines_done):
+                    pass
+                while batch := list(islice(items, INGEST_BATCH_SIZE)):
+                    valid = [item for item in batch if item is not None]
+                    new_ids, duplicates = await ingest_items(session, job, valid, collections) if valid else ([], 0)
+                    progress = progress | dict(
+                        added=progress['added'] + len(new_ids),
+                        duplicates=progress['duplicates'] + duplicates,
+                        invalid=progress['invalid'] + len(batch) - len(valid))
+                    job.progress = progress
+                    job.lines_done += len(batch)
+                    job.pending_ids = new_ids
+                    job.updated = datetime.utcnow()
+                    await session.commit()
+                    logger.info("Bulk job %d: %d lines, %s", job_id, job.lines_done, progress)
+                    await schedule_followup(job, new_ids, collections)
+        except Exception as e:
+            logger.exception(f"Bulk job {job_id} failed")
+            await session.rollback()
+            job.status = 'error'
+            job.error = str(e)
+            job.updated = datetime.utcnow()
+            await session.commit()
+            return
+        job.status = 'complete'
+        job.pending_ids = None
+        job.updated = datetime.utcnow()
+        await session.commit()
@@ -4,17 +4,16 @@ Copyright Society Library and Conversence 2022-2023
 
 from datetime import datetime, timezone
 from email.utils import parsedate_to_datetime
-from io import BytesIO
-from pathlib import Path
 
-import httpx
 from pytz import utc
-from sqlalchemy import delete
 from sqlalchemy.future import select
 
-from .. import get_analyzer_id, Session, hashfs, uri_equivalence
-from ..models import Document, Fragment
+from .. import config, get_analyzer_id, Session, uri_equivalence
+from ..models import Document
 from ..kafka import get_channel
+from ..downloader import downloader
+from ..file_store import file_store, FileTooLarge
+from ..file_gc import release_files
 from . import logger
 
 def parse_date(date):
@@ -22,43 +21,64 @@ def parse_date(date):
 
 
 version = 1
+MAX_DOWNLOAD_SIZE = config.getint("download", "max_size", fallback=100 * 1024 * 1024)
 
-async def do_download(doc_id):
+
+async def do_download(doc_id, refresh=False):
+    """Download a document. If it was downloaded before, only do so if refresh is set;
+    the request is then conditional on the stored etag and modification date.
+    No database connection is held during the request, which may be slow or retried."""
     analyzer_id = await get_analyzer_id("download", version)
     new_data = False
     async with Session() as session:
-        r = await session.execute(
-            select(Document).filter_by(id=doc_id))
-        doc = r.first()
+        doc = await session.get(Document, doc_id)
         if not doc:
-            logger.error(f"Missing document %d", doc_id)
+            logger.error("Missing document %d", doc_id)
             return None
-        doc = doc[0]
-        if doc.file_identity:
+        if doc.file_identity and not refresh:
             logger.warning("Already downloaded %d", doc_id)
             return None
-            # If you want to redownload, delete the file_identity and the fragments
-        async with httpx.AsyncClient() as client:
-            r = await client.get(doc.url, follow_redirects=True)
-        doc.return_code = r.status_code
-        if r.status_code == 200:
+        url = doc.url
+        conditional = (doc.etag, doc.modified) if doc.file_identity else ()
+    address = None
+    async with downloader.stream(url, *conditional) as r:
+        status_code = r.status_code
+        headers = r.headers
+        if status_code == 200:
+            try:
+                if MAX_DOWNLOAD_SIZE and int(headers.get('Content-Length') or 0) > MAX_DOWNLOAD_SIZE:
+                    raise FileTooLarge()
+                address = await file_store.put_stream(r.aiter_bytes(), MAX_DOWNLOAD_SIZE)
+            except FileTooLarge:
+                logger.warning("Document %d is larger than %d bytes", doc_id, MAX_DOWNLOAD_SIZE)
+                status_code = 413  # Content Too Large
+    async with Session() as session:
+        doc = await session.get(Document, doc_id)
+        if not doc:
+            logger.error("Document %d was deleted during its download", doc_id)
+            return None
+        if status_code == 304:
+            doc.retrieved = datetime.now(timezone.utc)
+            await session.commit()
+            logger.info("Unchanged document %d", doc_id)
+            return None
+        doc.return_code = status_code
+        released = ()
+        if address is not None:
             doc.retrieved = datetime.now(timezone.utc)
-            if last_modified := r.headers.get('Last-Modified', None):
-                doc.last_modified = parse_date(last_modified)
-            doc.mimetype = r.headers.get('Content-Type', 'text/html')
-            doc.language = r.headers.get('Content-Language', "en")
-            doc.etag = r.headers.get('ETag', None)
-            # no point streaming because hashfs is not async
-            address = hashfs.put(BytesIO(r.content))
+            if last_modified := headers.get('Last-Modified', None):
+                doc.modified = parse_date(last_modified)
+            doc.mimetype = headers.get('Content-Type', 'text/html')
+            doc.language = headers.get('Content-Language', "en")
+            doc.etag = headers.get('ETag', None)
             new_data = doc.file_identity != address.id
             if new_data:
                 if doc.file_identity:
-                    hashfs.delete(doc.file_identity)
-                    hashfs.delete(doc.text_identity)
-                    doc.text_identity = None
-                    await session.execute(delete(Fragment).where(doc_id=doc_id))
+                    # The processing task segments the new text against the existing fragments,
+                    # and releases the old text
+                    released = (doc.file_identity,)
                 doc.file_identity = address.id
-                doc.file_size = Path(address.abspath).stat().st_size
+                doc.file_size = await file_store.size(address.id)
                 if doc.file_size > 1000:
                     # Don't play equivalence with stubs
                     r = await session.execute(
@@ -69,18 +89,19 @@ async def do_download(doc_id):
                     if r := r.first():
                         (uri_eq,) = r
                         await uri_equivalence.merge(session, uri_eq, doc.uri)
-                        doc.delete()
+                        await session.delete(doc)
                         await session.commit()
+                        await release_files(session, *released)
                         logger.warn(f"Document with this file already exists at URL {uri_eq.uri}")
                         return
-        session.add(doc)
         await session.commit()
-        base_type = doc.mimetype.split(';')[0]
+        await release_files(session, *released)
+        base_type = (doc.mimetype or '').split(';')[0]
         if new_data:
             if (base_type == "application/pdf"):
-                await get_channel("process_pdf").send_soon(key=str(doc_id), value=doc_id)
+                await get_channel("process_pdf").send_soon(key=str(doc_id), value=dict(doc_id=doc_id, reparse=True))
             elif (base_type == "text/html"):
                 await get_channel("process_html").send_soon(key=str(doc_id), value=doc_id)
             elif (base_type in ("text/plain", "text/markdown")):
-                await get_channel("process_text").send_soon(key=str(doc_id), value=doc_id)
+                await get_channel("process_text").send_soon(key=str(doc_id), value=dict(doc_id=doc_id, from_file=True))
         return base_type if new_data else None
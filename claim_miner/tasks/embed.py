@@ -8,7 +8,8 @@ from sqlalchemy.future import select
 from sqlalchemy import cast, ARRAY, Float
 from sqlalchemy.orm import aliased
 
-from .. import Session, hashfs, get_analyzer_id
+from .. import Session, get_analyzer_id
+from ..file_store import file_store
 from ..embed import tf_embed
 from ..models import Document, Fragment, Collection, embed_models, BASE_EMBED_MODEL
 from . import logger
@@ -35,12 +36,7 @@ async def do_embed_doc(doc_ids, analyzer_id, model=BASE_EMBED_MODEL):
             logger.error("Missing document %s", doc_ids)
             return False
         docs = [doc for (doc,) in r]
-        texts = []
-        for doc in docs:
-            finfo = hashfs.get(doc.text_identity)
-            with open(finfo.abspath, 'r') as f:
-                text = f.read()
-            texts.append(text)
+        texts = [await file_store.read_text(doc.text_identity) for doc in docs]
         embeddings = await tf_embed(texts, model)
 
         for (doc, embedding) in zip(docs, embeddings):
@@ -63,18 +59,14 @@ async def do_embed_fragment(fragment_ids, analyzer_id, model=None, max_size=2000
         if not fragments:
             return [], excluded
         if max_size:
+            # tf_embed batches by size, so only oversized fragments need to be excluded.
             use = []
-            cumulative_size = 0
-
             for f in fragments:
                 l = len(f.text)
                 if l > max_size:
                     logger.warning(f"fragment %d has length %d > %d", f.id, l, max_size)
                     excluded.append(f.id)
                     continue
-                cumulative_size += l
-                if cumulative_size > max_size:
-                    break
                 use.append(f)
             fragments = use
         ids = [f.id for f in fragments]
@@ -93,7 +85,7 @@ async def do_embed_fragment(fragment_ids, analyzer_id, model=None, max_size=2000
 
 
 async def batch_embed(
-        documents=True, fragments=True, batch_size=10, model=BASE_EMBED_MODEL,
+        documents=True, fragments=True, batch_size=100, model=BASE_EMBED_MODEL,
         collection=None, pause_after=None, pause_length=60, max_size=20000):
     analyzer_id = await get_analyzer_id("embed", version)
     Embedding = embed_models[model]
@@ -153,7 +145,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--documents", action=argparse.BooleanOptionalAction, default=True)
     parser.add_argument("--fragments", action=argparse.BooleanOptionalAction, default=True)
-    parser.add_argument("--batch_size", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=100)
     parser.add_argument("--pause_after", type=int, default=None)
     parser.add_argument("--pause_length", type=int, default=60)
     parser.add_argument("--max_size", type=int, default=0)
@@ -2,26 +2,31 @@
 Copyright Society Library and Conversence 2022-2023
 """
 from pathlib import Path
-from google.cloud import bigquery
 from sqlalchemy import cast, ARRAY, Float
 from sqlalchemy.future import select
-from google.auth import load_credentials_from_file
 
 from .. import get_analyzer_id, Session, config, run_sync
 from ..models import Embedding_Use4 as Embedding, Fragment, Document, UriEquiv
 from ..kafka import get_channel
+from ..lazy import lazy_resource
 from . import logger
 
 version = 1
 
-client = None
-if credential_filename := config.get("base", "google_credentials", fallback=None):
+
+@lazy_resource("bigquery")
+def client():
+    "The BigQuery client, if configured"
+    if not (credential_filename := config.get("base", "google_credentials", fallback=None)):
+        return None
+    from google.auth import load_credentials_from_file
+    from google.cloud import bigquery
     credentials, project_id = load_credentials_from_file(
         Path(__file__).parent.parent.parent.joinpath(credential_filename)
     )
     # see https://cloud.google.com/bigquery/docs/reference/libraries
     # assumes GOOGLE_APPLICATION_CREDENTIALS points in the right place.
-    client = bigquery.Client(credentials=credentials)
+    return bigquery.Client(credentials=credentials)
 
 
 query_data = {
@@ -84,7 +89,7 @@ async def do_gdelt(claim_id, source='docs', limit=10, date=None):
             terms['where_'] += f' AND date >= "{date}"'
         queryt=query.format(embed=embed, limit=limit, **terms)
         def analyze():
-            return query(queryt)
+            return client.get().query(queryt)
 
         query_job =  await run_sync(analyze)()
         for row in query_job:
@@ -2,14 +2,23 @@
 The main worker loop for asynchronous events. Dispatches kafka messages to various tasks.
 """
 # Copyright Society Library and Conversence 2022-2023
-# TODO: create a worker pool.
 import logging
 import asyncio
 import atexit
 import traceback
+from collections import defaultdict
 
-from .. import get_analyzer_id, config, kafka as kafka_module
+from aiokafka import TopicPartition
+from aiokafka.errors import KafkaError
+
+from .. import get_analyzer_id, config, parse_embed_message, run_sync, kafka as kafka_module
 from ..kafka import get_consumer, stop_consumer, stop_producer, logger
+from ..models import BASE_EMBED_MODEL
+from ..ann import periodic_reindex
+from ..downloader import downloader
+from ..file_store import file_store
+from ..lazy import preload, PRELOAD
+from .bulk_upload import do_bulk_upload
 from .debatemap import do_debatemap
 from .download import do_download
 from .embed import do_embed_doc, do_embed_fragment, version
@@ -23,59 +32,236 @@ if "event_logging" in config:
     logging.basicConfig(**dict(config.items("event_logging", {})))
 
 
-async def worker():
-    global RUNNING
-    consumer = await get_consumer()
-    logger.info("Consumer ready")
-    async for msg in consumer:
-        if not RUNNING:
-            break
-        logger.debug(f"received %s %s", msg.topic, msg.value)
+# Default number of messages of each topic that are handled concurrently.
+# Can be overridden in the [worker] section of config.ini, eg `download_concurrency = 8`
+default_concurrency = dict(
+    bulk_upload=1,
+    debatemap=1,
+    # Politeness is enforced per host by the downloader
+    download=32,
+    embed=4,
+    gdelt=1,
+    process_html=4,
+    process_pdf=2,
+    process_text=4,
+)
+
+topic_concurrency = {
+    topic: config.getint("worker", f"{topic}_concurrency", fallback=default_concurrency.get(topic, 1))
+    for topic in kafka_module.topics
+}
+
+
+async def handle_message(msg):
+    logger.debug(f"received %s %s", msg.topic, msg.value)
+    try:
+        if msg.topic == "bulk_upload":
+            await do_bulk_upload(int(msg.value))
+        elif msg.topic == "debatemap":
+            params = msg.value.split()
+            if len(params) == 2:
+                claim_id, depth = params
+                depth = int(depth)
+            elif len(params) == 1:
+                claim_id = params[0]
+                depth = 1
+            await do_debatemap(claim_id, depth)
+        elif msg.topic == "download":
+            if isinstance(msg.value, dict):
+                await do_download(msg.value["doc_id"], msg.value.get("refresh", False))
+            else:
+                await do_download(int(msg.value))
+        elif msg.topic == "embed":
+            kind, ids, model = parse_embed_message(msg.value)
+            analyzer_id = await get_analyzer_id("embed", version)
+            if kind == 'D':
+                await do_embed_doc(ids, analyzer_id, model or BASE_EMBED_MODEL)
+            elif kind == 'F':
+                await do_embed_fragment(ids, analyzer_id, model)
+        elif msg.topic == "gdelt":
+            request = msg.value
+            claim_id = request['claim']
+            source = request.get('source', 'docs')
+            limit = request.get('limit', 10)
+            date = request.get('since', None)
+            await do_gdelt(claim_id, source, limit, date)
+        elif msg.topic == "process_html":
+            doc_id = int(msg.value)
+            await do_process_html(doc_id)
+        elif msg.topic == "process_pdf":
+            params = msg.value
+            if isinstance(params, dict):
+                doc_id = params.pop("doc_id")
+            else:
+                doc_id, params = int(params), {}
+            await do_process_pdf(doc_id, params)
+        elif msg.topic == "process_text":
+            params = msg.value
+            if isinstance(params, dict):
+                doc_id = params.pop("doc_id")
+            else:
+                doc_id, params = int(params), {}
+            await do_process_text(doc_id, **params)
+    except Exception as e:
+        traceback.print_exception(e)
+    logger.info("done %s %s", msg.topic, msg.value)
+
+
+class EmbedBatcher():
+    """Collects embed messages for a short window, or up to a number of items, grouped by kind and model.
+    Each group is then embedded with a single call to do_embed_doc or do_embed_fragment."""
+
+    def __init__(self, semaphore, max_items=100, window=1.0):
+        self.semaphore = semaphore
+        self.max_items = max_items
+        self.window = window
+        self.batches = {}
+        self.timers = {}
+        self.tasks = set()
+
+    async def add(self, msg):
+        "Add an embed message to a batch, and wait until that batch is processed."
+        kind, ids, model = parse_embed_message(msg.value)
+        if kind not in ('D', 'F'):
+            raise ValueError(f"Unknown embed message: {msg.value}")
+        if not ids:
+            return
+        key = (kind, model or BASE_EMBED_MODEL)
+        future = asyncio.get_running_loop().create_future()
+        batch = self.batches.setdefault(key, [])
+        was_empty = not batch
+        batch.extend((id, future) for id in ids)
+        if len(batch) >= self.max_items:
+            self.flush(key)
+        elif was_empty:
+            self.timers[key] = asyncio.get_running_loop().call_later(self.window, self.flush, key)
+        await future
+
+    def flush(self, key):
+        if timer := self.timers.pop(key, None):
+            timer.cancel()
+        if batch := self.batches.pop(key, None):
+            task = asyncio.create_task(self.process(key, batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def process(self, key, batch):
+        kind, model = key
+        ids = list(dict.fromkeys(id for (id, _) in batch))
         try:
-            if msg.topic == "debatemap":
-                params = msg.value.split()
-                if len(params) == 2:
-                    claim_id, depth = params
-                    depth = int(depth)
-                elif len(params) == 1:
-                    claim_id = params[0]
-                    depth = 1
-                await do_debatemap(claim_id, depth)
-            elif msg.topic == "download":
-                doc_id = int(msg.value)
-                await do_download(doc_id)
-            elif msg.topic == "embed":
-                ev_val = msg.value.split()
+            async with self.semaphore:
                 analyzer_id = await get_analyzer_id("embed", version)
-                ev_val, model = ev_val if len(ev_val) > 1 else (ev_val[0], None)
-                if ev_val.startswith('D'):
-                    await do_embed_doc([int(ev_val[1:])], analyzer_id, model)
-                elif ev_val.startswith('F'):
-                    await do_embed_fragment([int(ev_val[1:])], analyzer_id, model)
-            elif msg.topic == "gdelt":
-                request = msg.value
-                claim_id = request['claim']
-                source = request.get('source', 'docs')
-                limit = request.get('limit', 10)
-                date = request.get('since', None)
-                await do_gdelt(claim_id, source, limit, date)
-            elif msg.topic == "process_html":
-                doc_id = int(msg.value)
-                await do_process_html(doc_id)
-            elif msg.topic == "process_pdf":
-                params = msg.value
-                if isinstance(params, dict):
-                    doc_id = params.pop("doc_id")
+                if kind == 'D':
+                    await do_embed_doc(ids, analyzer_id, model)
                 else:
-                    doc_id, params = int(params), {}
-                await do_process_pdf(doc_id, params)
-            elif msg.topic == "process_text":
-                doc_id = int(msg.value)
-                await do_process_text(doc_id)
+                    await do_embed_fragment(ids, analyzer_id, model)
         except Exception as e:
             traceback.print_exception(e)
-        logger.info("done %s %s", msg.topic, msg.value)
+        finally:
+            for future in {future for (_, future) in batch}:
+                if not future.done():
+                    future.set_result(None)
+        logger.info("done embed %s%s %s", kind, ids, model)
+
+
+class WorkerPool():
+    """Runs message handlers concurrently, within per-topic limits.
+    Messages with the same key on the same topic are handled in order.
+    Offsets are committed only once a message and all earlier messages of its partition are done."""
 
+    def __init__(self, consumer, max_pending=256, embed_batcher=None):
+        self.consumer = consumer
+        self.semaphores = {topic: asyncio.Semaphore(n) for topic, n in topic_concurrency.items()}
+        self.embed_batcher = embed_batcher
+        self.pending = asyncio.Semaphore(max_pending)
+        self.key_tails = {}
+        self.offsets = defaultdict(dict)  # partition -> offset -> done
+        self.committed = {}
+        self.commit_lock = asyncio.Lock()
+        self.tasks = set()
+
+    async def submit(self, msg):
+        # Wait for a free slot, so we do not read much further than we can process
+        await self.pending.acquire()
+        partition = TopicPartition(msg.topic, msg.partition)
+        self.offsets[partition][msg.offset] = False
+        chain_key = (msg.topic, msg.key)
+        previous = self.key_tails.get(chain_key) if msg.key is not None else None
+        task = asyncio.create_task(self.run(msg, partition, previous))
+        self.tasks.add(task)
+        if msg.key is not None:
+            self.key_tails[chain_key] = task
+
+        def on_done(task):
+            self.tasks.discard(task)
+            if self.key_tails.get(chain_key) is task:
+                del self.key_tails[chain_key]
+        task.add_done_callback(on_done)
+
+    async def run(self, msg, partition, previous):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            if msg.topic == "embed" and self.embed_batcher is not None:
+                # The batcher applies the topic's concurrency limit to whole batches
+                try:
+                    await self.embed_batcher.add(msg)
+                except Exception as e:
+                    traceback.print_exception(e)
+            else:
+                async with self.semaphores[msg.topic]:
+                    await handle_message(msg)
+        finally:
+            self.pending.release()
+            await self.mark_done(partition, msg.offset)
+
+    async def mark_done(self, partition, offset):
+        offsets = self.offsets[partition]
+        offsets[offset] = True
+        last_done = None
+        for o in sorted(offsets):
+            if not offsets[o]:
+                break
+            last_done = o
+            del offsets[o]
+        if last_done is None:
+            return
+        async with self.commit_lock:
+            if last_done <= self.committed.get(partition, -1):
+                return
+            try:
+                await self.consumer.commit({partition: last_done + 1})
+                self.committed[partition] = last_done
+            except KafkaError as e:
+                # eg the partition was reassigned; the messages will be handled again
+                logger.warning("Could not commit %s: %s", partition, e)
+
+    async def join(self):
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+
+
+async def worker():
+    global RUNNING
+    consumer = await get_consumer()
+    logger.info("Consumer ready")
+    embed_batcher = EmbedBatcher(
+        asyncio.Semaphore(topic_concurrency["embed"]),
+        config.getint("worker", "embed_batch_items", fallback=100),
+        config.getfloat("worker", "embed_batch_window", fallback=1.0))
+    pool = WorkerPool(consumer, config.getint("worker", "max_pending", fallback=256), embed_batcher)
+    reindex_task = None
+    if reindex_interval := config.getint("ann", "reindex_interval", fallback=0):
+        reindex_task = asyncio.create_task(periodic_reindex(reindex_interval))
+    try:
+        async for msg in consumer:
+            if not RUNNING:
+                break
+            await pool.submit(msg)
+    finally:
+        if reindex_task:
+            reindex_task.cancel()
+        await pool.join()
 
 
 def exit_handler():
@@ -85,15 +271,21 @@ def exit_handler():
 atexit.register(exit_handler)
 
 async def finish():
+    await downloader.aclose()
     await stop_consumer()
     await stop_producer()
+    file_store.shutdown()
 
 async def run_and_stop():
+    if PRELOAD:
+        await run_sync(preload)(*PRELOAD)
     try:
         await worker()
     finally:
         await finish()
 
-if __name__ == "__main__":
-    # TODO: Multiple workers with a semaphore
+def main():
     asyncio.run(run_and_stop())
+
+if __name__ == "__main__":
+    main()
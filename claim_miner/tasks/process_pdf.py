@@ -1,28 +1,128 @@
 """
 Copyright Society Library and Conversence 2022-2023
 """
+import multiprocessing
+import os
 import re
-from io import BytesIO
-from pathlib import Path
+import signal
+import asyncio
+from io import StringIO
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import argparse
 
 from langdetect import detect
-from pdfminer.high_level import extract_text
-from sqlalchemy import delete
 from sqlalchemy.future import select
 from sqlalchemy.sql.functions import count
 
-from .. import Session, get_analyzer_id, hashfs, run_sync
+from .. import Session, get_analyzer_id, config
+from ..file_store import file_store
+from ..file_gc import release_files
 from ..models import Document, Fragment
+from ..segments import resegment
 from ..nlp import breakup_sentences
 from . import logger, schedule_fragment_embeds
 
 version = 1
-MIN_PARAGRAPH_LENGTH = 120
+
+# PDF extraction is CPU-bound, and runs in a pool of processes so it does not hold the worker's GIL
+PDF_WORKERS = config.getint("pdf", "workers", fallback=2)
+PDF_TIMEOUT = config.getint("pdf", "timeout", fallback=300)  # seconds per document
+PDF_MEMORY_MB = config.getint("pdf", "memory_mb", fallback=2048)  # per extraction process
+_pdf_pool = None
+
+
+def clean_paragraph(para):
+    # Convert single newlines to spaces
+    return re.sub(r'\s\s+', " ", re.sub(r'\s*\n\s*', ' ', para.strip()))
+
+
+def _address_space():
+    "The current size of the address space of the process in bytes, or 0 where unknown"
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def _init_pdf_process(memory_mb):
+    if memory_mb:
+        import resource
+        # The limit applies to the memory used by extraction, beyond what the interpreter and imports reserved
+        limit = _address_space() + memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _on_timeout(signum, frame):
+    raise TimeoutError("PDF extraction took too long")
+
+
+def extract_pdf_paragraphs(path, timeout=None):
+    """Extract the paragraphs of a PDF file, one page at a time. Runs in a pool process.
+    A paragraph that is not finished at the end of a page continues on the next one."""
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+    from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+    from pdfminer.pdfpage import PDFPage
+    if timeout:
+        signal.signal(signal.SIGALRM, _on_timeout)
+        signal.alarm(timeout)
+    try:
+        resources = PDFResourceManager()
+        laparams = LAParams()
+        paras = []
+        partial = ''
+        with open(path, 'rb') as fp:
+            for page in PDFPage.get_pages(fp):
+                output = StringIO()
+                device = TextConverter(resources, output, laparams=laparams)
+                PDFPageInterpreter(resources, device).process_page(page)
+                device.close()
+                chunks = re.split(r'\n\n+', partial + output.getvalue())
+                partial = chunks.pop()
+                paras.extend(clean_paragraph(p) for p in chunks if p.strip())
+        if partial.strip():
+            paras.append(clean_paragraph(partial))
+        return paras
+    finally:
+        if timeout:
+            signal.alarm(0)
+
+
+def make_pdf_pool(workers=PDF_WORKERS, memory_mb=PDF_MEMORY_MB):
+    """A pool of memory-limited processes.
+    They are started by a fork server, so they do not inherit the models loaded by the worker."""
+    return ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("forkserver"),
+        initializer=_init_pdf_process, initargs=(memory_mb,))
+
+
+def get_pdf_pool():
+    global _pdf_pool
+    if _pdf_pool is None:
+        _pdf_pool = make_pdf_pool()
+    return _pdf_pool
+
+
+async def extract_pdf(path):
+    "Extract the paragraphs of a PDF file in the process pool"
+    global _pdf_pool
+    loop = asyncio.get_running_loop()
+    pool = get_pdf_pool()
+    try:
+        return await loop.run_in_executor(pool, extract_pdf_paragraphs, path, PDF_TIMEOUT)
+    except BrokenProcessPool:
+        # A process died, probably from the memory cap; start a new pool for the next documents.
+        # Concurrent extractions fail together; only the broken pool is discarded.
+        pool.shutdown(wait=False, cancel_futures=True)
+        if _pdf_pool is pool:
+            _pdf_pool = None
+        raise MemoryError("PDF extraction process died")
 
 
 async def do_process_pdf(doc_id, process_params=None):
-    fragments = []
+    fragment_ids = []
     new_data = False
     process_params = process_params or {}
     analyzer_id = await get_analyzer_id("process_pdf", version)
@@ -39,43 +139,37 @@ async def do_process_pdf(doc_id, process_params=None):
         split_algo = process_params.get("split_algo", None)
         original_split_algo = doc.process_params.get("split_algo", None)
         if reparse or (split_algo != original_split_algo) or not doc.text_identity:
-            f = hashfs.get(doc.file_identity)
-
-            def do_extract():
-                return extract_text(f.abspath)
-
-            text = await run_sync(do_extract)()
-            paras = re.split(r'\n\n+', text)
-            # Convert single newlines to spaces
-            paras = [re.sub(r'\s\s+', " ", re.sub(r'\s*\n\s*', ' ', p.strip())) for p in paras if p.strip()]
+            f = await file_store.get(doc.file_identity)
+            try:
+                paras = await extract_pdf(f.abspath)
+            except (TimeoutError, MemoryError) as e:
+                logger.error(f"Could not extract text from document {doc_id}: {e}")
+                return False, []
             text = '\n'.join(paras)
-            text_address = hashfs.put(BytesIO(text.encode('utf-8')))
+            text_data = text.encode('utf-8')
+            text_address = await file_store.put(text_data)
             new_data = doc.text_identity != text_address.id
         if not new_data:
             # check if the paragraphs are missing
             num_paras = await session.scalar(select(count(Fragment.id)).filter_by(doc_id=doc_id, scale='paragraph'))
-            new_data = num_paras == 0
-        if new_data:
-            if doc.text_identity:
-                # TODO: check if used by another document
-                hashfs.delete(doc.text_identity)
-                await session.execute(delete(Fragment).where(doc_id=doc_id))
-            doc.text_identity = text_address.id
-            doc.text_size = Path(text_address.abspath).stat().st_size
-            doc.text_analyzer_id = analyzer_id
-            doc.language = detect(text)
-            session.add(doc)
-            char_pos = 0
-            for (para_pos, para) in enumerate(paras):
-                if len(para) >= MIN_PARAGRAPH_LENGTH:
-                    # TODO: Check if exists. If so, update. (Unique index?)
-                    f = Fragment(text=para, doc_id=doc_id, char_position=char_pos, position=para_pos, scale="paragraph",
-                                 language=doc.language)
-                    session.add(f)
-                    fragments.append(f)
-                char_pos += 1 + len(para)
-        else:
-            return False, []
+            if num_paras:
+                return False, []
+            # Segment the stored text again
+            text = await file_store.read_text(doc.text_identity)
+            paras = text.split('\n')
+            text_data = text.encode('utf-8')
+            text_address = await file_store.get(doc.text_identity)
+            new_data = True
+        old_text_id = doc.text_identity
+        text_changed = old_text_id != text_address.id
+        doc.text_identity = text_address.id
+        doc.text_size = len(text_data)
+        doc.text_analyzer_id = analyzer_id
+        doc.language = detect(text)
+        session.add(doc)
+        fragment_ids = await resegment(session, doc, paras, text_changed)
         await session.commit()
-    await schedule_fragment_embeds([f.id for f in fragments], doc_id=doc_id)
+        if text_changed:
+            await release_files(session, old_text_id)
+    await schedule_fragment_embeds(fragment_ids, doc_id=doc_id)
     return new_data
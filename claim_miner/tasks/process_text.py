@@ -1,31 +1,29 @@
 """
 Copyright Society Library and Conversence 2022-2023
 """
-from pathlib import Path
-import re
 
 from sqlalchemy.future import select
 from langdetect import detect
 from sqlalchemy.sql.functions import count
 
-from .. import Session, hashfs, get_analyzer_id, run_sync
+from .. import Session, get_analyzer_id, run_sync
+from ..file_store import file_store
 from ..models import Document, Fragment
+from ..file_gc import release_files
+from ..segments import resegment
 from . import logger, schedule_fragment_embeds
 
 version = 1
+TEXT_MIMETYPES = ("text/plain", "text/markdown")
 
-MIN_PARAGRAPH_LENGTH = 120
 
-def collapse_whitespace_and_paras(s):
-    s = re.sub(r'[ \t\f\v\xa0]+', ' ', s)
-    return re.sub(r'([ \t\f\v\xa0]?\n[ \t\f\v\xa0]?)+', '\n', s).strip()
+async def do_process_text(doc_id, from_file=False):
+    """Segment the text of a document into paragraphs.
 
-def collapse_whitespace_with_paras(s):
-    return re.sub(r'\s+', ' ', s).strip()
-
-async def do_process_text(doc_id):
-    new_data = False
-    fragments = []
+    :param from_file: take the text from the document's file, which a download replaced,
+        rather than from its stored text (e.g. the text extracted from a JSONL line)
+    """
+    fragment_ids = []
     analyzer_id = await get_analyzer_id("process_text", version)
     async with Session() as session:
         r = await session.execute(
@@ -36,33 +34,28 @@ async def do_process_text(doc_id):
             return False, []
 
         doc = doc[0]
-        text_id = hashfs.get(doc.text_identity or doc.file_identity)
-        doc.text_identity = text_id.id
-
-        def do_get_text():
-            with open(text_id.abspath, 'r') as f:
-                text = f.read()
-            paras = text.split("\n")
-            return text, paras, detect(text)
-        text, paras, lang = await run_sync(do_get_text)()
-        doc.language = lang
-        # check if the paragraphs are missing
-        num_paras = await session.scalar(select(count(Fragment.id)).filter_by(doc_id=doc_id))
-        new_data = num_paras == 0
-        if new_data:
-            doc.text_size = Path(text_id.abspath).stat().st_size
-            doc.text_analyzer_id = analyzer_id
-            session.add(doc)
-            char_pos = 0
-            for (para_pos, para) in enumerate(paras):
-                if len(para) >= MIN_PARAGRAPH_LENGTH:
-                    # TODO: Check if exists. If so, update. (Unique index?)
-                    f = Fragment(text=para, doc_id=doc_id, char_position=char_pos, position=para_pos, scale="paragraph", language=doc.language)
-                    session.add(f)
-                    fragments.append(f)
-                char_pos += 1 + len(para)
+        old_text_id = doc.text_identity
+        if from_file and doc.file_identity and (doc.mimetype or '').split(';')[0] in TEXT_MIMETYPES:
+            # The text of a downloaded text document is its file
+            text_id = await file_store.get(doc.file_identity)
         else:
-            return False, []
+            text_id = await file_store.get(doc.text_identity or doc.file_identity)
+        text_changed = old_text_id != text_id.id
+        doc.text_identity = text_id.id
+        text = await file_store.read_text(text_id.id)
+        paras = text.split("\n")
+        doc.language = await run_sync(detect)(text)
+        if not text_changed:
+            # check if the paragraphs are missing
+            num_paras = await session.scalar(select(count(Fragment.id)).filter_by(doc_id=doc_id, scale='paragraph'))
+            if num_paras:
+                return False, []
+        doc.text_size = await file_store.size(text_id.id)
+        doc.text_analyzer_id = analyzer_id
+        session.add(doc)
+        fragment_ids = await resegment(session, doc, paras, text_changed)
         await session.commit()
-    await schedule_fragment_embeds([f.id for f in fragments], doc_id=doc_id)
+        if text_changed:
+            await release_files(session, old_text_id)
+    await schedule_fragment_embeds(fragment_ids, doc_id=doc_id)
     return True
@@ -10,7 +10,8 @@ from sqlalchemy.sql.functions import count, func
 from sqlalchemy.orm import aliased, joinedload
 
 from .models import UriEquiv, Fragment, Document, Analysis, analysis_context_table
-from . import Session, hashfs
+from . import Session
+from .file_gc import release_files
 from .uri import normalize
 
 
@@ -121,15 +122,13 @@ async def _migrate():
         by_norm = defaultdict(list)
         for doc in docs:
             by_norm[normalize(doc.url)].append(doc)
+        released = set()
         for docs in by_norm.values():
             latest = docs[0]
             for doc in docs[1:]:
                 await session.delete(doc.uri)
                 await session.delete(doc)
-                if doc.file_identity and doc.file_identity != latest.file_identity:
-                    hashfs.delete(doc.file_identity)
-                if doc.text_identity and doc.text_identity != latest.file_identity:
-                    hashfs.delete(doc.text_identity)
+                released.update((doc.file_identity, doc.text_identity))
         await session.flush()
 
         for uri, docs in by_norm.items():
@@ -137,6 +136,7 @@ async def _migrate():
             latest.uri.uri = uri
             latest.uri.status = 'canonical'
         await session.commit()
+        await release_files(session, *released)
 
 
 # TODO: Case of an attempted merge because of DOI collision but the text content is clearly different.
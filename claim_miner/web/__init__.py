@@ -81,6 +81,7 @@ async def get_base_template_vars(current_user, collection=None, session=None):
 
 
 from .auth_routes import *
+from .bulk import *
 from .docs import *
 from .search import *
 from .dashboard import *
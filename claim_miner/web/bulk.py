@@ -0,0 +1,56 @@
+"""
+Bulk uploads are processed by the worker as :py:class:`claim_miner.models.BulkJob`.
+This module creates the jobs and reports their progress.
+"""
+# Copyright Society Library and Conversence 2022-2023
+from quart import jsonify
+from quart_jwt_extended import jwt_required, get_jwt_identity
+from werkzeug.exceptions import NotFound, Unauthorized
+
+from .. import Session
+from ..file_store import file_store
+from ..models import BulkJob
+from ..app import app, login_required, current_user, get_channel
+from ..auth import set_user
+
+
+async def start_bulk_job(kind, fs, params, collection, added_by):
+    """Store the uploaded file and queue its processing by the worker.
+
+    :param fs: the uploaded file
+    :param collection: the collection receiving the upload, or the global scope
+    :returns: the new job
+    """
+    file_identity = await file_store.put(fs.stream)
+    async with Session() as session:
+        job = BulkJob(
+            kind=kind, file_identity=file_identity.id, params=params,
+            collection_id=collection.id if collection else None, added_by=added_by)
+        session.add(job)
+        await session.commit()
+    await get_channel("bulk_upload").send_soon(key=str(job.id), value=job.id)
+    return job
+
+
+async def get_bulk_job_status(job_id, user):
+    async with Session() as session:
+        job = await session.get(BulkJob, job_id)
+    if job is None:
+        raise NotFound()
+    if not (job.added_by == user.auth_id or await user.can('admin')):
+        raise Unauthorized()
+    return jsonify(job.as_dict())
+
+
+@app.route("/bulk_job/<int:job_id>")
+@app.route("/c/<collection>/bulk_job/<int:job_id>")
+@login_required
+async def bulk_job_status(job_id, collection=None):
+    return await get_bulk_job_status(job_id, current_user)
+
+
+@app.route("/api/bulk_job/<int:job_id>")
+@jwt_required
+async def bulk_job_status_json(job_id):
+    current_user = await set_user(get_jwt_identity())
+    return await get_bulk_job_status(job_id, current_user)
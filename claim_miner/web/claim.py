@@ -2,15 +2,14 @@
 Copyright Society Library and Conversence 2022-2023
 """
 from datetime import datetime
-from io import TextIOWrapper, BytesIO
-from csv import reader, writer
+from io import StringIO
+from csv import writer
 from itertools import chain
 
 import simplejson as json
-from quart import request, render_template, redirect, jsonify, Response
+from quart import request, render_template, redirect, Response
 from quart_jwt_extended import jwt_required, get_jwt_identity
 from quart.wrappers import Response
-from quart.wrappers.response import IOBody
 from werkzeug.exceptions import NotFound, Unauthorized, BadRequest
 from sqlalchemy import Integer, Float, cast
 from sqlalchemy.sql import desc, literal_column
@@ -28,6 +27,10 @@ from ..app import app, login_required, current_user, get_channel, logger
 from ..auth import may_require_collection_permission, fragment_collection_constraints, set_user
 from . import get_collection, update_fragment_selection, get_base_template_vars, schedule_fragment_embeds, get_collections_and_scope
 from ..debatemap_client import export_node, debatemap_query, path_query
+from ..ann import set_search_params
+from ..mmr import mmr_window
+from ..search_cursor import search_token, get_window, set_window, rank_window, fetch_page
+from .bulk import start_bulk_job
 
 
 mimetypes = {
@@ -148,22 +151,65 @@ async def add_claim_link_json(id, collection=None):
 
 
 
+EXPORT_BATCH_SIZE = 1000
+
+
+async def stream_rows(query):
+    "Yield the rows of a query in batches, through a server-side cursor"
+    async with Session() as session:
+        r = await session.stream(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        async for rows in r.partitions():
+            yield rows
+
+
+async def stream_csv(query, header):
+    output = StringIO()
+    csv = writer(output, dialect='excel', delimiter=';')
+    csv.writerow(header)
+    async for rows in stream_rows(query):
+        csv.writerows(rows)
+        yield output.getvalue().encode('utf-8')
+        output.seek(0)
+        output.truncate()
+    if output.tell():
+        yield output.getvalue().encode('utf-8')
+
+
+async def stream_ndjson(query):
+    async for rows in stream_rows(query):
+        yield "".join(json.dumps(row._asdict()) + "\n" for row in rows).encode('utf-8')
+
+
+async def stream_json(query):
+    "Stream a JSON array, a batch of rows at a time"
+    first = True
+    async for rows in stream_rows(query):
+        items = ",\n".join(json.dumps(row._asdict()) for row in rows)
+        yield (("[\n" if first else ",\n") + items).encode('utf-8')
+        first = False
+    yield ("[]" if first else "\n]").encode('utf-8')
+
+
 @app.route("/claim")
 @app.route("/c/<collection>/claim")
 @may_require_collection_permission('access')
 async def list_claims(collection=None):
+    """List claims. Data exports (CSV, JSON or NDJSON, by type or Accept header) are streamed;
+    with all=true, they include all the claims rather than one page."""
     offset = request.args.get("start", type=int, default=0)
     limit = request.args.get("limit", type=int, default=30)
     search_text = request.args.get("search_text", type=str, default=None)
     filetype = request.args.get("type", None)
-    as_json = filetype=='json' or (request.accept_mimetypes.quality("application/json") > request.accept_mimetypes.quality("text/html"))
+    export_all = as_bool(request.args.get("all"))
+    as_ndjson = filetype=='ndjson' or (request.accept_mimetypes.quality("application/x-ndjson") > request.accept_mimetypes.quality("text/html"))
+    as_json = not as_ndjson and (filetype=='json' or (request.accept_mimetypes.quality("application/json") > request.accept_mimetypes.quality("text/html")))
     as_csv = filetype=='csv' or (request.accept_mimetypes.quality("text/csv") > request.accept_mimetypes.quality("text/html"))
-    as_data = as_json or as_csv
+    as_data = as_json or as_csv or as_ndjson
     async with Session() as session:
         base_vars = await get_base_template_vars(current_user, collection, session)
         collection = base_vars['collection']
         if as_data:
-            query = select(Fragment).filter(Fragment.is_visible_claim)
+            query = select(Fragment.id, Fragment.scale.label("type"), Fragment.text).filter(Fragment.is_visible_claim)
         else:
             query = select(Fragment, count(Analysis.id).label("num_analysis")).filter(Fragment.is_visible_claim
                 ).outerjoin(Analysis, cast(Analysis.params['theme'], Integer)==Fragment.id
@@ -174,34 +220,30 @@ async def list_claims(collection=None):
             tsquery = func.plainto_tsquery(en_regconfig, search_text).label('tsquery')
             vtext = func.to_tsvector(Fragment.text)
             tsrank = func.ts_rank_cd(vtext, tsquery).label('rank')
-            query = query.filter(Fragment.ptmatch()(tsquery)).rank(desc(tsrank))
+            query = query.filter(Fragment.ptmatch()(tsquery)).order_by(desc(tsrank))
         else:
             query = query.order_by(Fragment.id)
-        r = await session.execute(query.offset(offset).limit(limit))
-        claims = r.fetchall()
-        claim_indices = []
-        if offset == 0 and not as_data:
-            query = select(Fragment).filter_by(scale="standalone_root").order_by(Fragment.text)
-            if collection or not await current_user.can('access'):
-                query = await fragment_collection_constraints(query, collection)
-            r = await session.execute(query)
-            claim_indices = [c for (c,) in r.fetchall()]
-    if as_json:
-        title = f"claims_{collection.name}.json" if collection else "claims.json"
-        r = jsonify([dict(id=claim.id, text=claim.text, type=claim.scale) for (claim,) in claims])
-        r.headers.add("content-disposition", f"attachment;filename={title}")
-        return r
+        if as_data:
+            if not export_all:
+                query = query.offset(offset).limit(limit)
+            basename = f"claims_{collection.name}" if collection else "claims"
+        else:
+            r = await session.execute(query.offset(offset).limit(limit))
+            claims = r.fetchall()
+            claim_indices = []
+            if offset == 0:
+                query = select(Fragment).filter_by(scale="standalone_root").order_by(Fragment.text)
+                if collection or not await current_user.can('access'):
+                    query = await fragment_collection_constraints(query, collection)
+                r = await session.execute(query)
+                claim_indices = [c for (c,) in r.fetchall()]
+    # Exports are streamed from their own session, so the response starts with the first rows
+    if as_ndjson:
+        return Response(stream_ndjson(query), mimetype="application/x-ndjson", headers={"content-disposition": f"attachment;filename={basename}.ndjson"})
+    elif as_json:
+        return Response(stream_json(query), mimetype="application/json", headers={"content-disposition": f"attachment;filename={basename}.json"})
     elif as_csv:
-        title = f"claims_{collection.name}.csv" if collection else "claims.csv"
-        output = BytesIO()
-        output_utf8 = TextIOWrapper(output, encoding="utf-8")
-        csv = writer(output_utf8, dialect='excel', delimiter=';')
-        csv.writerow(["id", "type", "text"])
-        for (claim,) in claims:
-            csv.writerow([claim.id, claim.scale, claim.text])
-        output_utf8.detach()
-        output.seek(0)
-        return Response(IOBody(output), mimetype="text/csv", headers={"content-disposition": f"attachment;filename={title}"})
+        return Response(stream_csv(query, ["id", "type", "text"]), mimetype="text/csv", headers={"content-disposition": f"attachment;filename={basename}.csv"})
     previous = max(offset - limit, 0) if offset > 0 else ""
     next_ = (offset + limit) if len(claims) == limit else ""
     end = offset + len(claims)
@@ -390,18 +432,23 @@ async def search_on_claim(id, collection=None):
             query = query.filter(neighbour.scale.in_(scales))
         else:
             query = query.filter(neighbour.scale == scales[0])
-        if mode == 'semantic':
+        # Later pages are sliced from the window ranked by the first one
+        token = search_token(('search_on_claim', mode, id, model, collection.path, tuple(scales), lam if mode == 'mmr' else None))
+        entry = get_window(token)
+        window = entry.window if entry else None
+        if window is None or not window.covers(offset, limit):
+            await set_search_params(session, min_rows=offset + limit)
             subq = select(target.embedding).filter_by(fragment_id=id, analyzer_id=analyzer_id).scalar_subquery()
-            distance = neighbour_embedding.distance()(subq).label('rank')
-            query = query.add_columns(distance).order_by(distance)
-        elif mode == 'mmr':
-            mmr = func.mmr(None, id, Embedding.__table__.name, scales, limit+offset, lam, 1000).table_valued("id", "score")
-            query = query.join(mmr, mmr.columns.id == neighbour.id
-                ).add_columns(mmr.columns.score.label('rank')).order_by(desc(mmr.columns.score))
-        query = query.limit(limit).offset(offset)
-        r = await session.execute(query)
-        r = r.fetchall()
-        next_ = (offset + limit) if len(r) == limit else ""
+            distance = neighbour_embedding.distance()(subq)
+            if mode == 'mmr':
+                window = await mmr_window(
+                    session, query.filter(neighbour.id != id), neighbour.id, neighbour_embedding.embedding, distance, lam)
+            else:
+                window = await rank_window(session, query, neighbour.id, distance, offset + limit)
+            set_window(token, window)
+        r = await fetch_page(session, query, neighbour.id, window, offset, limit)
+        # A neighbour has a row for each of its key points
+        next_ = (offset + limit) if len({row['fragment_id'] for row in r}) == limit else ""
         return await render_template(
             "search.html", theme_id=id, text=claim.text, results=r, lam=lam, model=model,
             offset=offset, limit=limit, prev=prev, next=next_, selection=selection, include_paragraphs=include_paragraphs,
@@ -511,7 +558,6 @@ async def upload_claims(collection=None):
     error = ""
     success = ""
     warning = ""
-    repeats = []
     new_ids = []
     form = await request.form
     base_vars = await get_base_template_vars(current_user, collection)
@@ -524,37 +570,13 @@ async def upload_claims(collection=None):
         raise BadRequest("No file")
     files = await request.files
     fs = files.get("file")
-    r = reader(TextIOWrapper(fs, "utf-8"))
-    if as_bool(form.get("skip")):
-        next(r)
-    column = int(form.get("column")) - 1
-    claim_texts = [row[column].strip() for row in r]
     node_type = form.get("node_type")
-    claims = []
-    async with Session() as session:
-        for claim_text in claim_texts:
-            # Check if it exists first
-            existing = await session.execute(select(Fragment).filter(Fragment.text==claim_text, Fragment.scale.in_(standalone_type_names)).limit(1))
-            if existing := existing.first():
-                # Ensure in collection, right type
-                repeats.append(existing.id)
-                continue
-            claim = Fragment(text=claim_text, scale=node_type, language="en", char_position=0, position=0, created_by=current_user.auth_id)
-            if collection:
-                claim.collections = [collection]
-            session.add(claim)
-            claims.append(claim)
-        if claims:
-            await session.commit()
-            for claim in claims:
-                # TODO Batch embedding requests
-                await schedule_fragment_embeds([claim.id], [collection])
-                new_ids.append(claim.id)
-            success = f"Success, {len(new_ids)} created"
-            if repeats:
-                warning = f"Already existing: {repeats}"
-        else:
-            warning = "All those claim already exist"
+    if node_type not in standalone_type_names:
+        raise BadRequest("Invalid claim type")
+    params = dict(skip=as_bool(form.get("skip")), column=int(form.get("column")) - 1, node_type=node_type)
+    # Processed by the worker; progress is available at the job's URL
+    job = await start_bulk_job("claims_csv", fs, params, collection, current_user.auth_id)
+    success = f"Upload queued as job {job.id}, see {collection.path}/bulk_job/{job.id} for progress"
     return await render_template(
         "upload_claims.html", error=error, success=success, warning=warning,
         new_ids=new_ids, **base_vars)
@@ -2,23 +2,31 @@
 Copyright Society Library and Conversence 2022-2023
 """
 from pathlib import Path
-from google.auth import load_credentials_from_file
-from googleapiclient.discovery import build
 from quart import request
 from quart_cors import route_cors
+from werkzeug.exceptions import NotFound
 from .. import config
 from ..app import app, logger
+from ..lazy import lazy_resource
 
-cse = None
 cx = config.get("cse", "cx", fallback=None)
 credential_filename = config.get("cse", "google_credentials", fallback=None)
-if cx and credential_filename:
+
+
+@lazy_resource("cse")
+def cse():
+    "The Google custom search API, if configured"
+    if not (cx and credential_filename):
+        return None
+    from google.auth import load_credentials_from_file
+    from googleapiclient.discovery import build
     credentials, project_id = load_credentials_from_file(
         Path(__file__).parent.parent.parent.joinpath(credential_filename)
     )
     scredentials = credentials.with_scopes(['https://www.googleapis.com/auth/cse'])
     service = build('customsearch', 'v1', credentials=scredentials)
-    cse = service.cse()
+    return service.cse()
+
 
 @app.route("/cse_proxy", methods=["GET"])
 @route_cors(allow_origin='*')
@@ -27,6 +35,8 @@ async def cse_proxy():
     offset = request.args.get('offset', type=int, default=1)
     # limit is always 10.
     logger.debug("cse: %s", dict(q=q, start=offset, cx=cx))
-    req = cse.list(cx=cx, q=q, start=offset)
+    if (cse_api := cse.get()) is None:
+        raise NotFound("Custom search is not configured")
+    req = cse_api.list(cx=cx, q=q, start=offset)
     logger.debug(req)
     return req.execute()
@@ -1,31 +1,30 @@
 """
 Copyright Society Library and Conversence 2022-2023
 """
-from io import BytesIO, TextIOWrapper
 from datetime import datetime
-from csv import reader
 from collections import defaultdict
 from itertools import groupby, chain
-from pathlib import Path
-import re
 
 import simplejson as json
-from quart import request, render_template, send_file, jsonify
+from quart import request, render_template, send_file, jsonify, redirect, Response
 from quart_jwt_extended import jwt_required, get_jwt_identity
 from werkzeug.exceptions import Unauthorized, BadRequest, NotFound
 from sqlalchemy import cast, Float, Boolean
 from sqlalchemy.sql.functions import count, max as fmax, min as fmin, coalesce
 from sqlalchemy.sql.expression import func
 from sqlalchemy.orm import aliased, subqueryload
-import isodate
 
-from .. import Session, select, hashfs, as_bool
+from .. import Session, select, as_bool, run_sync
+from ..file_store import file_store
 from ..models import Analysis, Document, Fragment, ClaimLink, Collection, UriEquiv, embed_models
 from ..app import app, current_user, get_channel, logger
-from ..auth import may_require_collection_permission, doc_collection_constraints, check_doc_access, requires_collection_permission, set_user
-from ..nlp import as_prompts
+from ..auth import (
+    may_require_collection_permission, doc_collection_constraints, doc_access_condition, check_doc_access,
+    requires_collection_permission, set_user)
+from ..nlp import iter_prompts, NLP_BATCH_SIZE
 from ..uri import normalize
 from .. import uri_equivalence
+from .bulk import start_bulk_job
 from . import render_with_spans, get_collection, get_base_template_vars, get_collections_and_scope
 
 mimetypes = {
@@ -66,14 +65,18 @@ async def list_docs(collection=None):
 async def get_raw_doc(doc_id, collection=None):
     async with Session() as session:
         collection = await get_collection(collection, session, current_user.auth_id)
-        r = await session.execute(select(Document.file_identity, Document.mimetype).filter_by(id=doc_id))
+        r = await session.execute(select(
+            Document.file_identity, Document.mimetype, Document.public_contents, await doc_access_condition(collection)
+            ).filter_by(id=doc_id))
+        r = r.first()
         if r is None:
             raise NotFound()
-        (file_identity, mimetype, public_contents) = r.first()
+        (file_identity, mimetype, public_contents, accessible) = r
         if not (public_contents or await current_user.can('admin')):
             raise Unauthorized("Copyrighted content")
-        await check_doc_access(doc_id, collection)
-        file_info = hashfs.get(file_identity)
+        if not accessible:
+            raise Unauthorized()
+        file_info = await file_store.get(file_identity)
         extension = mimetype.split("/")[1]
         return await send_file(file_info.abspath, mimetype, True, f"{doc_id}.{extension}")
 
@@ -101,14 +104,18 @@ async def get_raw_doc_api(doc_id, collection=None):
     current_user = await set_user(get_jwt_identity())
     async with Session() as session:
         collection = await get_collection(collection, session, current_user.auth_id)
-        r = await session.execute(select(Document.file_identity, Document.mimetype).filter_by(id=doc_id))
+        r = await session.execute(select(
+            Document.file_identity, Document.mimetype, Document.public_contents, await doc_access_condition(collection)
+            ).filter_by(id=doc_id))
+        r = r.first()
         if r is None:
             raise NotFound()
-        (file_identity, mimetype, public_contents) = r.first()
+        (file_identity, mimetype, public_contents, accessible) = r
         if not (public_contents or await current_user.can('admin')):
             raise Unauthorized("Copyrighted content")
-        await check_doc_access(doc_id, collection)
-        file_info = hashfs.get(file_identity)
+        if not accessible:
+            raise Unauthorized()
+        file_info = await file_store.get(file_identity)
         extension = mimetype.split("/")[1]
         return await send_file(file_info.abspath, mimetype, True, f"{doc_id}.{extension}")
 
@@ -128,13 +135,15 @@ async def get_doc_info(doc_id: int, collection=None):
     async with Session() as session:
         base_vars = await get_base_template_vars(current_user, collection, session)
         collection = base_vars['collection']
-        await check_doc_access(doc_id, collection)
         r = await session.execute(
-            select(Document).filter(Document.id==doc_id).limit(1))
+            select(Document, await doc_access_condition(collection)).filter(Document.id==doc_id).limit(1))
         # TODO: Add the claims
+        r = r.first()
         if r is None:
             raise NotFound()
-        (doc,) = r.first()
+        (doc, accessible) = r
+        if not accessible:
+            raise Unauthorized()
         public_contents = doc.public_contents or await current_user.can('admin')
         # Count available embeddings
         num_embeddings = dict()
@@ -216,20 +225,36 @@ async def get_doc_info(doc_id: int, collection=None):
             renderings=renderings, **base_vars)
 
 
+@app.route("/doc/<int:doc_id>/refresh", methods=["POST"])
+@app.route("/c/<collection>/doc/<int:doc_id>/refresh", methods=["POST"])
+@may_require_collection_permission('add_document')
+async def refresh_doc(doc_id, collection=None):
+    "Download the document again, if it changed since it was retrieved"
+    async with Session() as session:
+        collection = await get_collection(collection, session, current_user.auth_id)
+        await check_doc_access(doc_id, collection, 'add_document', session)
+    await get_channel("download").send_soon(key=str(doc_id), value=dict(doc_id=doc_id, refresh=True))
+    return redirect(f"{collection.path}/doc/{doc_id}")
+
+
 @app.route("/doc/<int:doc_id>/text")
 @app.route("/c/<collection>/doc/<int:doc_id>/text")
 @may_require_collection_permission('access')
 async def get_text_doc(doc_id, collection=None):
     async with Session() as session:
         collection = await get_collection(collection, session, current_user.auth_id)
-        r = await session.execute(select(Document.text_identity, Document.mimetype, Document.public_contents).filter_by(id=doc_id))
+        r = await session.execute(select(
+            Document.text_identity, Document.mimetype, Document.public_contents, await doc_access_condition(collection)
+            ).filter_by(id=doc_id))
+        r = r.first()
         if r is None:
             raise NotFound()
-        (text_identity, mimetype, public_contents) = r.first()
+        (text_identity, mimetype, public_contents, accessible) = r
         if not (public_contents or await current_user.can('admin')):
             raise Unauthorized("Copyrighted content")
-        await check_doc_access(doc_id, collection)
-        file_info = hashfs.get(text_identity)
+        if not accessible:
+            raise Unauthorized()
+        file_info = await file_store.get(text_identity)
         return await send_file(file_info.abspath, mimetype, True, f"{doc_id}.txt")
 
 
@@ -240,66 +265,21 @@ async def get_text_doc_api(doc_id, collection=None):
     current_user = await set_user(get_jwt_identity())
     async with Session() as session:
         collection = await get_collection(collection, session, current_user.auth_id)
-        r = await session.execute(select(Document.text_identity, Document.mimetype, Document.public_contents).filter_by(id=doc_id))
+        r = await session.execute(select(
+            Document.text_identity, Document.mimetype, Document.public_contents, await doc_access_condition(collection)
+            ).filter_by(id=doc_id))
+        r = r.first()
         if r is None:
             raise NotFound()
-        (file_identity, mimetype, public_contents) = r.first()
+        (file_identity, mimetype, public_contents, accessible) = r
         if not (public_contents or await current_user.can('admin')):
             raise Unauthorized("Copyrighted content")
-        await check_doc_access(doc_id, collection)
-        file_info = hashfs.get(file_identity)
+        if not accessible:
+            raise Unauthorized()
+        file_info = await file_store.get(file_identity)
         return await send_file(file_info.abspath, mimetype, True, f"{doc_id}.txt")
 
 
-def compose_url_jsonl(data, spec):
-    if '|' in spec:
-        specs = spec.split('|')
-        for spec in specs:
-            if url := compose_url_jsonl(data, spec):
-                return url
-    part_specs = spec.split(',')
-    parts = []
-    for spec in part_specs:
-        spec = spec.strip()
-        if spec.startswith("'"):
-            parts.append(spec.strip("'"))
-            continue
-        slugify = spec.startswith("#")
-        spec = spec.strip("#")
-        prefix = None
-        if '-' in spec:
-            spec, prefix = spec.split('-')
-            prefix = int(prefix)
-        part = data.get(spec, None)
-        if slugify:
-            part = part.encode('ascii', 'replace').decode('ascii')
-            part = re.sub(r'\W+', "_", part, 0, re.ASCII)
-            part = part.strip('_')
-        if part == "n/a":
-            part = None
-        if not part:
-            return None
-        if prefix:
-            part = part[prefix:]
-        parts.append(part)
-    return "/".join(parts)
-
-
-def maybe_flatten(str_or_list):
-    if isinstance(str_or_list, list):
-        return "\n\n".join(str_or_list)
-    return str_or_list
-
-
-def get_text_jsonl(data, text_fields="text", text_process=None):
-    text_fields = text_fields.split(",")
-    text = "\n\n".join(maybe_flatten(data.get(field.strip(), "")) for field in text_fields)
-    if text_process:
-        for pat, repl in text_process:
-            text = re.sub(pat, repl, text)
-    return text
-
-
 @app.route("/doc/upload", methods=['GET', 'POST'])
 @app.route("/c/<collection>/doc/upload", methods=['GET', 'POST'])
 @may_require_collection_permission('add_document')
@@ -309,7 +289,7 @@ async def upload_docs(collection=None):
     warning = ""
     new_ids = []
     if request.method == 'POST':
-        await request.get_data()
+        # The form parser spools uploaded files to disk; do not load the whole body with get_data
         form = await request.form
         collections = []
         try:
@@ -336,9 +316,9 @@ async def upload_docs(collection=None):
                         if not mimetype:
                             warning = f"unknown file extension: {extension}"
                             logger.warn(warning)
-                        file_identity = hashfs.put(BytesIO(fs.stream.read()))
+                        file_identity = await file_store.put(fs.stream)
                         text_identity_id = file_identity.id if extension == "txt" else None
-                        if Path(file_identity.abspath).stat.st_size > 1000:
+                        if await file_store.size(file_identity.id) > 1000:
                             # Avoid identifying small stubs
                             r = await session.execute(select(Document.uri).filter_by(file_identity=file_identity.id).limit(1))
                             if r := r.first():
@@ -368,83 +348,23 @@ async def upload_docs(collection=None):
                         await get_channel("process_text").send_soon(key=str(doc.id), value=doc.id)
                 else:
                     await get_channel("download").send_soon(key=str(doc.id), value=doc.id)
-            elif form.get("upload_type") == "csv":
+            elif form.get("upload_type") in ("csv", "jsonl"):
                 files = await request.files
                 fs = files.get("file")
-                r = reader(TextIOWrapper(fs, "utf-8"))
-                if as_bool(form.get("skip")):
-                    next(r)
-                column = int(form.get("column")) - 1
-                urls = [row[column].strip() for row in r]
-                urls = [normalize(url) for url in urls if url.startswith("http")]  # basic sanity check
-                async with Session() as session:
-                    uris, existing = uri_equivalence.add_urls(session, urls)
-                    if existing:
-                        logger.warn(f"Already existing URLs: {[uri.uri for uri in existing]}")
-                    docs = [
-                        Document(
-                            uri=uri,
-                            added_by=current_user.auth_id,
-                            collections=collections,
-                        )
-                        for uri in uris
-                    ]
-                    session.add_all(docs)
-                    await session.commit()
-                for doc in docs:
-                    await get_channel("download").send_soon(key=str(doc.id), value=doc.id)
-                success = f"{len(docs)} documents added"
-            elif form.get("upload_type") == "jsonl":
-                files = await request.files
-                fs = files.get("file")
-                r = TextIOWrapper(fs, "utf-8")
-                url_spec = form.get("url_spec")
-                text_fields = form.get("text_fields", "text")
-                use_title = as_bool(form.get("use_title", "true"))
-                use_published = as_bool(form.get("use_published", "false"))
-                extra_newlines = as_bool(form.get("extra_newlines", "false"))
-                published_field = "date_published"
-                urls = set()
-                docs = []
-                async with Session() as session:
-                    for line in r:
-                        data = json.loads(line)
-                        url = normalize(compose_url_jsonl(data, url_spec))
-                        if url in urls:
-                            continue
-                        urls.add(url)
-                        text = get_text_jsonl(data, text_fields, [[r" \n\n", " "]] if extra_newlines else None)
-                        title = data.get("title") if use_title else None
-                        published = None
-                        if use_published:
-                            published = data[published_field]
-                            if published == 'n/a':
-                                published = None
-                            if published:
-                                if ' ' in published:
-                                    published = 'T'.join(published.split())
-                                if 'T' in published:
-                                    published = isodate.parse_datetime(published)
-                                else:
-                                    published = isodate.parse_date(published)
-                        if isinstance(text, list):
-                            text = "\n".join(text)
-                        existing = await session.scalar(select(count(UriEquiv.uri)).filter_by(uri=url))
-                        if existing:
-                            continue
-                        json_as_file = hashfs.put(BytesIO(line.encode('utf-8')))
-                        txt_as_file = hashfs.put(BytesIO(text.encode('utf-8')))
-                        docs.append(Document(
-                            uri=UriEquiv(uri=url), added_by=current_user.auth_id, title=title, collections=collections,
-                            file_identity=json_as_file.id, file_size=Path(json_as_file.abspath).stat().st_size,
-                            text_identity=txt_as_file.id, text_size=Path(txt_as_file.abspath).stat().st_size,
-                            mimetype='text/plain', created=published, return_code=200))
-                    for doc in docs:
-                        session.add(doc)
-                    await session.commit()
-                for doc in docs:
-                    await get_channel("process_text").send_soon(key=str(doc.id), value=doc.id)
-                success = f"{len(docs)} documents added"
+                if form.get("upload_type") == "csv":
+                    kind = "docs_csv"
+                    params = dict(skip=as_bool(form.get("skip")), column=int(form.get("column")) - 1)
+                else:
+                    kind = "docs_jsonl"
+                    params = dict(
+                        url_spec=form.get("url_spec"),
+                        text_fields=form.get("text_fields", "text"),
+                        use_title=as_bool(form.get("use_title", "true")),
+                        use_published=as_bool(form.get("use_published", "false")),
+                        extra_newlines=as_bool(form.get("extra_newlines", "false")))
+                # Processed by the worker; progress is available at the job's URL
+                job = await start_bulk_job(kind, fs, params, collection_ob, current_user.auth_id)
+                success = f"Upload queued as job {job.id}, see {collection_ob.path}/bulk_job/{job.id} for progress"
         except Exception as e:
             logger.exception("")
             error = str(e)
@@ -487,19 +407,22 @@ async def add_doc_json(collection=None):
 @app.route("/c/<collection>/doc/<int:doc_id>/completion_prompts")
 @may_require_collection_permission('access')
 async def as_completions(doc_id, collection=None):
-    await check_doc_access(doc_id, collection)
-    io = BytesIO()
-    tf = TextIOWrapper(io, encoding='utf-8')
     async with Session() as session:
         collection = await get_collection(collection, session, current_user.auth_id)
+        await check_doc_access(doc_id, collection, session=session)
         fragment_query = select(Fragment.text).filter(Fragment.doc_id==doc_id, Fragment.scale=="paragraph"
             ).order_by(Fragment.position)
         r = await session.execute(fragment_query)
-        for (para,) in r:
-            for (prompt, completion) in as_prompts(para):
-                json.dump(dict(prompt=prompt, completion=completion), tf, False)
-                tf.write("\n")
-    tf.flush()
-    io.seek(0)
-    io = BytesIO(io.read())     # WHY IS THIS NECESSARY?
-    return await send_file(io, "application/json-l", True, f"prompts_{doc_id}.jsonl")
+        paras = [para for (para,) in r]
+
+    def prompts_batch(batch):
+        return "".join(
+            json.dumps(dict(prompt=prompt, completion=completion)) + "\n"
+            for prompts in iter_prompts(batch) for (prompt, completion) in prompts)
+
+    async def stream_prompts():
+        # Parse in batches off the event loop, sending each batch's prompts as they are ready
+        for start in range(0, len(paras), NLP_BATCH_SIZE):
+            yield (await run_sync(prompts_batch)(paras[start:start + NLP_BATCH_SIZE])).encode('utf-8')
+
+    return Response(stream_prompts(), mimetype="application/json-l", headers={"content-disposition": f"attachment;filename=prompts_{doc_id}.jsonl"})
@@ -81,7 +81,6 @@ async def claim_scatter(claim_id=None, collection=None):
     if len(keywords)==1:
         keywords = [t.strip() for t in keywords[0].split(",")]
     if keywords:
-        # TODO: cache keyword embed results to avoid recurring costs
         kwembeds = await tf_embed(keywords, model)
         all_embeds = embeds + kwembeds
         similarities = await run_sync(lambda: cosine_similarity(embeds, kwembeds).tolist())()
@@ -2,10 +2,8 @@
 Copyright Society Library and Conversence 2022-2023
 """
 from sqlalchemy.future import select
-from sqlalchemy.sql import desc, cast, func, literal_column
+from sqlalchemy.sql import desc, func, literal_column
 from sqlalchemy.orm import aliased
-from sqlalchemy import cast, func
-from pgvector.sqlalchemy import Vector
 from quart import request, render_template, jsonify
 from quart_jwt_extended import jwt_required, get_jwt_identity
 from werkzeug.exceptions import Unauthorized, BadRequest
@@ -16,6 +14,10 @@ from ..models import (
     visible_standalone_types, BASE_EMBED_MODEL)
 from ..app import app, logger, current_user
 from ..embed import tf_embed
+from ..ann import set_search_params
+from ..mmr import mmr_window
+from ..search_cursor import (
+    search_token, get_window, set_window, rank_window, fetch_page, make_cursor, parse_cursor)
 from ..auth import may_require_collection_permission, set_user
 from . import update_fragment_selection, get_collections_and_scope, get_base_template_vars
 
@@ -116,20 +118,26 @@ async def search(collection=None):
             tsrank = func.ts_rank_cd(vtext, tsquery).label('rank')
             query = query.add_columns(tsrank)
             query = query.filter(func.starts_with(Fragment.language, 'en')).filter(Fragment.ptmatch('english')(tsquery)).order_by(desc(tsrank))
+            query = query.limit(limit).offset(offset)
+            r = await session.execute(query)
+            r = r.fetchall()
+        elif mode in ('semantic', 'mmr'):
+            # Later pages are sliced from the window ranked by the first one
+            token = search_token(('search', mode, text, model, collection.path, tuple(scales), lam if mode == 'mmr' else None))
+            entry = get_window(token)
+            window = entry.window if entry else None
+            if window is None or not window.covers(offset, limit):
+                text_embed = await tf_embed(text, model)
+                await set_search_params(session, min_rows=offset + limit)
+                distance = Embedding.distance()(text_embed)
+                if mode == 'mmr':
+                    window = await mmr_window(session, query, Fragment.id, Embedding.embedding, distance, lam)
+                else:
+                    window = await rank_window(session, query, Fragment.id, distance, offset + limit)
+                set_window(token, window)
+            r = await fetch_page(session, query, Fragment.id, window, offset, limit)
         else:
-            text_embed = await tf_embed(text, model)
-            if mode == 'semantic':
-                rank = Embedding.distance()(text_embed).label('rank')
-                query = query.add_columns(rank).order_by(rank)
-            elif mode == 'mmr':
-                mmr = func.mmr(cast(text_embed, Vector), None, Embedding.__table__.name, scales, limit+offset, lam, 1000).table_valued("id", "score")
-                query = query.join(mmr, mmr.columns.id == Fragment.id
-                    ).add_columns(mmr.columns.score).order_by(desc(mmr.columns.score))
-            else:
-                raise BadRequest("Unknown mode")
-        query = query.limit(limit).offset(offset)
-        r = await session.execute(query)
-        r = r.fetchall()
+            raise BadRequest("Unknown mode")
     next_ = (offset + limit) if len(r) == limit else ""
     end = offset + len(r)
 
@@ -139,58 +147,91 @@ async def search(collection=None):
         include_paragraphs=include_paragraphs, model=model, models=list(embed_models.keys()), prompt_analyzers=prompt_analyzers, **base_vars)
 
 
+def json_search_query(search_paras, collection_names, Embedding):
+    if search_paras:
+        query = select(Fragment.doc_id, Fragment.id, Fragment.position, Fragment.text, UriEquiv.uri.label('url'), Document.title
+            ).join(Document, Document.id==Fragment.doc_id
+            ).join(UriEquiv, Document.uri_id==UriEquiv.id
+            ).filter(Fragment.scale=='paragraph')
+        if collection_names:
+            query = query.join(Collection, Document.collections).filter(Collection.name.in_(collection_names))
+    else:
+        query = select(Fragment.id, Fragment.text, Fragment.scale.label("node_type")).filter(Fragment.scale.in_(visible_standalone_types))
+        if collection_names:
+            query = query.join(Collection, Fragment.collections).filter(Collection.name.in_(collection_names))
+    return query.join(Embedding, Embedding.fragment_id==Fragment.id)
+
+
 @app.route("/api/search", methods=['POST'])
 @app.route("/api/c/<collection>/search", methods=["POST"])
 @jwt_required
 async def search_json(collection=None):
+    """Semantic search. Returns a list of results; if there may be more, the
+    X-Next-Cursor header gives a cursor that can be posted alone to get the next page."""
     current_user = await set_user(get_jwt_identity())
     json = await request.json
     if not json:
         raise BadRequest("Please post JSON")
-    text = json['text']
-    offset = json.get("offset", 0)
-    limit = json.get("limit", 20)
-    mode = json.get("mode", "semantic")
-    search_paras = as_bool(json.get("search_paragraphs", ""))
-    if mode not in ("semantic", "mmr"):
-        raise BadRequest("mode must be one of semantic or mmr")
-    if mode == "mmr":
-        lam = json.get("lambda", 0.7)
-        if not isinstance(lam, float):
-            raise BadRequest("lambda must be a float")
-        if not 0 <= lam <= 1:
-            raise BadRequest("lambda must be between 0 and 1")
+    ef_search = json.get("ef_search", None)
+    probes = json.get("probes", None)
+    for (name, value) in (("ef_search", ef_search), ("probes", probes)):
+        if value is not None and not (isinstance(value, int) and value > 0):
+            raise BadRequest(f"{name} must be a positive integer")
+    if cursor := json.get("cursor", None):
+        try:
+            token, offset, limit = parse_cursor(cursor)
+        except ValueError as e:
+            raise BadRequest(str(e))
+        entry = get_window(token, current_user.auth_id)
+        if entry is None:
+            raise BadRequest("This cursor has expired, please repeat the search")
+        params = entry.params
+    else:
+        entry = None
+        text = json['text']
+        offset = json.get("offset", 0)
+        limit = json.get("limit", 20)
+        mode = json.get("mode", "semantic")
+        lam = None
+        if mode not in ("semantic", "mmr"):
+            raise BadRequest("mode must be one of semantic or mmr")
+        if mode == "mmr":
+            lam = json.get("lambda", 0.7)
+            if not isinstance(lam, float):
+                raise BadRequest("lambda must be a float")
+            if not 0 <= lam <= 1:
+                raise BadRequest("lambda must be between 0 and 1")
+        params = dict(text=text, mode=mode, lam=lam, search_paras=as_bool(json.get("search_paragraphs", "")),
+                      exact=as_bool(json.get("exact", "")))
     async with Session() as session:
-        collections, collection = await get_collections_and_scope(json.get('collection', collection), user_id=current_user.auth_id)
-        can_see = await collection.user_can(current_user, 'access')
-        if not can_see:
-            return Unauthorized()
-        scales = list(visible_standalone_types)
-        model = json.get("model", collection.embed_model())
-        if model not in embed_models:
-            raise BadRequest("Invalid model")
-        Embedding = embed_models[model]
-        if search_paras:
-            query = select(Fragment.doc_id, Fragment.id, Fragment.position, Fragment.text, UriEquiv.uri.label('url'), Document.title
-                ).join(Document, Document.id==Fragment.doc_id
-                ).join(UriEquiv, Document.uri_id==UriEquiv.id
-                ).filter(Fragment.scale=='paragraph')
-            if collections:
-                query = query.join(Collection, Document.collections).filter(Collection.name.in_([c.name for c in collections]))
-        else:
-            query = select(Fragment.id, Fragment.text, Fragment.scale.label("node_type")).filter(Fragment.scale.in_(visible_standalone_types))
-            if collections:
-                query = query.join(Collection, Fragment.collections).filter(Collection.name.in_([c.name for c in collections]))
-
-        query = query.join(Embedding, Embedding.fragment_id==Fragment.id)
-        text_embed = await tf_embed(text, model)
-        if mode == 'semantic':
-            rank = Embedding.distance()(text_embed).label('rank')
-            query = query.add_columns(rank).order_by(rank)
-        elif mode == 'mmr':
-            mmr = func.mmr(cast(text_embed, Vector), None, Embedding.__table__.name, scales, limit+offset, lam, 1000).table_valued("id", "score")
-            query = query.join(mmr, mmr.columns.id == Fragment.id
-                ).add_columns(mmr.columns.score).order_by(desc(mmr.columns.score))
-        query = query.limit(limit).offset(offset)
-        r = await session.execute(query)
-        return jsonify([row._asdict() for row in r])
+        if entry is None:
+            collections, collection = await get_collections_and_scope(json.get('collection', collection), user_id=current_user.auth_id)
+            can_see = await collection.user_can(current_user, 'access')
+            if not can_see:
+                return Unauthorized()
+            params['model'] = json.get("model", collection.embed_model())
+            if params['model'] not in embed_models:
+                raise BadRequest("Invalid model")
+            params['collections'] = [c.name for c in collections]
+            token = search_token(('search_json', current_user.auth_id, tuple(sorted(params.items(), key=lambda i: i[0]))))
+            # The same search may have been done recently
+            entry = get_window(token, current_user.auth_id)
+        mode = params['mode']
+        Embedding = embed_models[params['model']]
+        query = json_search_query(params['search_paras'], params['collections'], Embedding)
+        window = entry.window if entry else None
+        if window is None or not window.covers(offset, limit):
+            text_embed = await tf_embed(params['text'], params['model'])
+            exact = params.get('exact', False)
+            await set_search_params(session, ef_search, probes, offset + limit, exact)
+            distance = Embedding.distance()(text_embed)
+            if mode == 'mmr':
+                window = await mmr_window(session, query, Fragment.id, Embedding.embedding, distance, params['lam'], exact)
+            else:
+                window = await rank_window(session, query, Fragment.id, distance, offset + limit, exact)
+            set_window(token, window, current_user.auth_id, params)
+        r = await fetch_page(session, query, Fragment.id, window, offset, limit, 'score' if mode == 'mmr' else 'rank')
+    headers = {}
+    if len(r) == limit:
+        headers['X-Next-Cursor'] = make_cursor(token, offset + limit, limit)
+    return jsonify(r), 200, headers
@@ -0,0 +1,30 @@
+-- Deploy bulk_job
+-- requires: user
+-- requires: collection
+-- Copyright Society Library and Conversence 2022-2023
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.bulk_job (
+    id bigint NOT NULL DEFAULT nextval('public.topic_id_seq'::regclass) PRIMARY KEY,
+    kind varchar NOT NULL,
+    status public.process_status NOT NULL DEFAULT 'pending',
+    file_identity varchar NOT NULL,
+    params JSONB NOT NULL DEFAULT '{}'::JSONB,
+    collection_id bigint,
+    added_by bigint,
+    created timestamp without time zone NOT NULL DEFAULT now(),
+    updated timestamp without time zone NOT NULL DEFAULT now(),
+    lines_done integer NOT NULL DEFAULT 0,
+    pending_ids bigint[],
+    progress JSONB NOT NULL DEFAULT '{}'::JSONB,
+    error text,
+    CONSTRAINT bulk_job_collection_id_fkey FOREIGN KEY (collection_id)
+      REFERENCES public.collection (id) ON DELETE CASCADE ON UPDATE CASCADE,
+    CONSTRAINT bulk_job_added_by_fkey FOREIGN KEY (added_by)
+      REFERENCES public.user (id) ON DELETE SET NULL ON UPDATE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS bulk_job_status_idx ON bulk_job (status);
+
+COMMIT;
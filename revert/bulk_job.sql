@@ -0,0 +1,8 @@
+-- Deploy bulk_job
+
+
+BEGIN;
+
+DROP TABLE IF EXISTS bulk_job;
+
+COMMIT;
@@ -0,0 +1,84 @@
+"""
+Tests of the resumption of bulk upload jobs
+"""
+# Copyright Society Library and Conversence 2022-2023
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("aiokafka")
+from claim_miner.tasks import bulk_upload  # noqa: E402
+
+
+class FakeSession():
+    def __init__(self, job):
+        self.job = job
+        self.committed = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def get(self, cls, id):
+        return self.job
+
+    async def commit(self):
+        self.committed.append(dict(lines_done=self.job.lines_done, pending_ids=self.job.pending_ids))
+
+    async def rollback(self):
+        pass
+
+
+def make_job(tmp_path, lines_done=0, pending_ids=None):
+    path = tmp_path / "upload.csv"
+    path.write_text("".join(f"http://example.com/{n}\n" for n in range(3)))
+    return SimpleNamespace(
+        id=1, kind='docs_csv', status='ongoing', file_identity=str(path), params=dict(column=0),
+        collection_id=None, added_by=None, lines_done=lines_done, pending_ids=pending_ids, progress={},
+        updated=None, error=None)
+
+
+@pytest.fixture
+def followups(monkeypatch):
+    followups = []
+
+    async def get(id):
+        return SimpleNamespace(abspath=id)
+
+    async def ingest_items(session, job, items, collections):
+        return [100 + job.lines_done + n for n in range(len(items))], 0
+
+    async def schedule_followup(job, new_ids, collections):
+        followups.append(list(new_ids))
+
+    monkeypatch.setattr(bulk_upload, "file_store", SimpleNamespace(get=get))
+    monkeypatch.setattr(bulk_upload, "ingest_items", ingest_items)
+    monkeypatch.setattr(bulk_upload, "schedule_followup", schedule_followup)
+    monkeypatch.setattr(bulk_upload, "INGEST_BATCH_SIZE", 2)
+    return followups
+
+
+def run(monkeypatch, job):
+    session = FakeSession(job)
+    monkeypatch.setattr(bulk_upload, "Session", lambda: session)
+    asyncio.run(bulk_upload.do_bulk_upload(job.id))
+    return session
+
+
+def test_followups_are_committed_with_their_batch(monkeypatch, tmp_path, followups):
+    job = make_job(tmp_path)
+    session = run(monkeypatch, job)
+    assert followups == [[100, 101], [102]]
+    assert dict(lines_done=2, pending_ids=[100, 101]) in session.committed
+    assert job.status == 'complete' and job.pending_ids is None
+
+
+def test_resume_resends_followups_of_last_batch(monkeypatch, tmp_path, followups):
+    job = make_job(tmp_path, lines_done=2, pending_ids=[100, 101])
+    run(monkeypatch, job)
+    assert followups == [[100, 101], [102]]
+    assert job.lines_done == 3 and job.status == 'complete'
@@ -0,0 +1,71 @@
+"""
+Tests of the micro-batching of embed messages in the worker
+"""
+# Copyright Society Library and Conversence 2022-2023
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("aiokafka")
+from claim_miner.tasks import kafka  # noqa: E402
+
+
+class RecordingBatcher(kafka.EmbedBatcher):
+    "Records the batches instead of embedding them"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.processed = []
+
+    async def process(self, key, batch):
+        self.processed.append((key, [id for (id, _) in batch]))
+        for (_, future) in batch:
+            if not future.done():
+                future.set_result(None)
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 5))
+
+
+def test_multi_id_message_flushes_after_window():
+    async def scenario():
+        batcher = RecordingBatcher(asyncio.Semaphore(1), max_items=100, window=0.01)
+        await batcher.add(SimpleNamespace(value="F[1,2,3]"))
+        return batcher.processed
+
+    processed = run(scenario())
+    assert processed == [(('F', kafka.BASE_EMBED_MODEL), [1, 2, 3])]
+
+
+def test_messages_share_a_batch():
+    async def scenario():
+        batcher = RecordingBatcher(asyncio.Semaphore(1), max_items=100, window=0.05)
+        await asyncio.gather(
+            batcher.add(SimpleNamespace(value="F[1,2]")),
+            batcher.add(SimpleNamespace(value="F3")))
+        return batcher.processed
+
+    processed = run(scenario())
+    assert processed == [(('F', kafka.BASE_EMBED_MODEL), [1, 2, 3])]
+
+
+def test_full_batch_flushes_at_once():
+    async def scenario():
+        batcher = RecordingBatcher(asyncio.Semaphore(1), max_items=3, window=60)
+        await batcher.add(SimpleNamespace(value="D[1,2,3,4]"))
+        return batcher.processed
+
+    processed = run(scenario())
+    assert processed == [(('D', kafka.BASE_EMBED_MODEL), [1, 2, 3, 4])]
+
+
+def test_empty_message_returns():
+    async def scenario():
+        batcher = RecordingBatcher(asyncio.Semaphore(1), max_items=100, window=60)
+        await batcher.add(SimpleNamespace(value="F[]"))
+        return batcher.processed, batcher.batches
+
+    processed, batches = run(scenario())
+    assert processed == [] and batches == {}
@@ -0,0 +1,41 @@
+"""
+Tests of the memory limit of the PDF extraction processes
+"""
+# Copyright Society Library and Conversence 2022-2023
+import sys
+
+import pytest
+
+if not sys.platform.startswith("linux"):
+    pytest.skip("address space limits are only enforced on Linux", allow_module_level=True)
+pytest.importorskip("langdetect")
+from claim_miner.tasks import process_pdf  # noqa: E402
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def pool():
+    pool = process_pdf.make_pdf_pool(1, 128)
+    yield pool
+    pool.shutdown()
+
+
+def test_allocation_within_limit(pool):
+    assert len(pool.submit(bytearray, 32 * MB).result(60)) == 32 * MB
+
+
+def test_allocation_beyond_limit(pool):
+    with pytest.raises(MemoryError):
+        pool.submit(bytearray, 512 * MB).result(60)
+
+
+def test_limit_ignores_parent_address_space():
+    # Memory reserved by the parent, as by loaded models, does not count against the limit
+    reserved = bytearray(256 * MB)
+    fresh = process_pdf.make_pdf_pool(1, 128)
+    try:
+        assert len(fresh.submit(bytearray, 32 * MB).result(60)) == 32 * MB
+    finally:
+        fresh.shutdown()
+        del reserved
@@ -0,0 +1,116 @@
+"""
+Tests of the segmentation of text documents
+"""
+# Copyright Society Library and Conversence 2022-2023
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("langdetect")
+from claim_miner.tasks import process_text  # noqa: E402
+
+LINE = '{"url": "http://example.com/a", "text": "First paragraph.\\nSecond paragraph."}'
+TEXT = "First paragraph.\nSecond paragraph."
+DOWNLOADED = "Downloaded paragraph."
+
+
+class FakeSession():
+    def __init__(self, doc, num_paras):
+        self.doc = doc
+        self.num_paras = num_paras
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def execute(self, query):
+        return SimpleNamespace(first=lambda: (self.doc,))
+
+    async def scalar(self, query):
+        return self.num_paras
+
+    def add(self, obj):
+        pass
+
+    async def commit(self):
+        pass
+
+
+class FakeFileStore():
+    def __init__(self, files):
+        self.files = files
+
+    async def get(self, id):
+        return SimpleNamespace(id=id)
+
+    async def read_text(self, id):
+        return self.files[id]
+
+    async def size(self, id):
+        return len(self.files[id])
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = dict(resegment=[], released=[])
+
+    async def resegment(session, doc, paras, text_changed):
+        calls['resegment'].append((paras, text_changed))
+        return []
+
+    async def release_files(session, *ids):
+        calls['released'].extend(ids)
+
+    async def noop(*args, **kwargs):
+        return 1
+
+    def run_sync(func):
+        async def wrapper(*args):
+            return func(*args)
+        return wrapper
+
+    monkeypatch.setattr(process_text, "file_store", FakeFileStore(dict(line=LINE, text=TEXT, new_file=DOWNLOADED)))
+    monkeypatch.setattr(process_text, "resegment", resegment)
+    monkeypatch.setattr(process_text, "release_files", release_files)
+    monkeypatch.setattr(process_text, "get_analyzer_id", noop)
+    monkeypatch.setattr(process_text, "schedule_fragment_embeds", noop)
+    monkeypatch.setattr(process_text, "run_sync", run_sync)
+    monkeypatch.setattr(process_text, "detect", lambda text: "en")
+    return calls
+
+
+def jsonl_doc():
+    "A document as stored by the JSONL ingestion: the line as file, the extracted text as text"
+    return SimpleNamespace(id=1, file_identity="line", text_identity="text", mimetype="text/plain", language="en")
+
+
+def process(monkeypatch, doc, num_paras, **params):
+    monkeypatch.setattr(process_text, "Session", lambda: FakeSession(doc, num_paras))
+    return asyncio.run(process_text.do_process_text(doc.id, **params))
+
+
+def test_reprocess_jsonl_doc_keeps_extracted_text(monkeypatch, calls):
+    doc = jsonl_doc()
+    process(monkeypatch, doc, 0)
+    assert doc.text_identity == "text"
+    assert calls['resegment'] == [(TEXT.split("\n"), False)]
+    assert calls['released'] == []
+
+
+def test_reprocess_jsonl_doc_with_paragraphs_does_nothing(monkeypatch, calls):
+    doc = jsonl_doc()
+    assert process(monkeypatch, doc, 2) == (False, [])
+    assert doc.text_identity == "text"
+    assert calls['resegment'] == [] and calls['released'] == []
+
+
+def test_downloaded_text_replaces_stored_text(monkeypatch, calls):
+    doc = jsonl_doc()
+    doc.file_identity = "new_file"
+    process(monkeypatch, doc, 2, from_file=True)
+    assert doc.text_identity == "new_file"
+    assert calls['resegment'] == [([DOWNLOADED], True)]
+    assert calls['released'] == ["text"]
@@ -0,0 +1,27 @@
+"""
+Tests of the worker startup
+"""
+# Copyright Society Library and Conversence 2022-2023
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiokafka")
+from claim_miner.tasks import kafka  # noqa: E402
+
+
+def test_run_and_stop_preloads_resources(monkeypatch):
+    calls = []
+
+    async def worker():
+        calls.append("worker")
+
+    async def finish():
+        calls.append("finish")
+
+    monkeypatch.setattr(kafka, "PRELOAD", ["spacy", "use4"])
+    monkeypatch.setattr(kafka, "preload", lambda *names: calls.append(("preload", names)))
+    monkeypatch.setattr(kafka, "worker", worker)
+    monkeypatch.setattr(kafka, "finish", finish)
+    asyncio.run(kafka.run_and_stop())
+    assert calls == [("preload", ("spacy", "use4")), "worker", "finish"]